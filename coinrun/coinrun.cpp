@@ -1386,6 +1386,7 @@ struct State {
   QMutex step_mutex;
    bool step_in_progress = false;
    bool agent_ready = false;
+   bool result_pending = false; // stepped, but not yet collected by vec_wait*
 };
 
 void state_reset(const std::shared_ptr<State>& state)
@@ -1847,6 +1848,7 @@ class VectorOfStates {
 public:
   int nenvs;
   int handle;
+  bool black_white = false; // agent observations are copied out as single channel luma
   QMutex states_mutex;
   std::vector<std::shared_ptr<State>> states; // nenvs
 };
@@ -1883,6 +1885,18 @@ void copy_render_buf(int e, uint8_t* obs_rgb, uint8_t* buf, int res_w, int res_h
   }
 }
 
+static
+void copy_render_buf_gray(int e, uint8_t* obs_gray, uint8_t* buf, int res_w, int res_h)
+{
+  for (int y = 0; y<res_h; y++) {
+    for (int x = 0; x<res_w; x++) {
+      const uint8_t* q = buf + y*res_w*4 + x*4;
+      // fixed-point ITU-R 601 luma, the weights sum to 256 so white stays at 255
+      obs_gray[e*res_h*res_w + y*res_w + x] = (77*q[2] + 150*q[1] + 29*q[0]) >> 8;
+    }
+  }
+}
+
 static
 void copy_audio_buf(int e, uint8_t* obs_audio, uint8_t* buf, int dim)
 {
@@ -2023,6 +2037,98 @@ public:
 
 static std::vector<std::shared_ptr<QThread>> all_threads;
 
+// Copy one finished env out to the given output slot. Specialized at compile time on whether hires
+// video data is copied and whether the observation is converted to luma, so the per-env copy has no
+// runtime flag checks.
+template<bool COLLECT_DATA, bool BLACK_WHITE>
+static
+void collect_result(
+  int slot,
+  const std::shared_ptr<State>& state_e,
+  uint8_t* obs_rgb,
+  uint8_t* obs_hires_rgb,
+  uint8_t* obs_audio_seg_map,
+  float* rew,
+  bool* done,
+  bool* new_level)
+{
+  QMutexLocker lock2(&state_e->state_mutex);
+  // don't really need a mutex, because step is completed, but it's cheap to lock anyway
+  Agent& a = state_e->agent;
+  if (COLLECT_DATA) {
+    assert(a.collect_data);
+    copy_render_buf(slot, obs_hires_rgb, a.render_hires_buf, VIDEORES, VIDEORES);
+    copy_audio_buf(slot, obs_audio_seg_map, a.audio_seg_map_buf, AUDIO_MAP_SIZE);
+  }
+  if (BLACK_WHITE)
+    copy_render_buf_gray(slot, obs_rgb, a.render_buf, RES_W, RES_H);
+  else
+    copy_render_buf(slot, obs_rgb, a.render_buf, RES_W, RES_H);
+
+  rew[slot] = a.reward;
+  done[slot] = a.game_over;
+  new_level[slot] = state_e->maze->is_new_level;
+  a.reward = 0;
+  a.game_over = false;
+  state_e->maze->is_new_level = false;
+}
+
+typedef void (*collect_result_fn)(
+  int, const std::shared_ptr<State>&, uint8_t*, uint8_t*, uint8_t*, float*, bool*, bool*);
+
+static
+collect_result_fn select_collect_result(bool collect_data, bool black_white)
+{
+  if (collect_data)
+    return black_white ? collect_result<true, true> : collect_result<true, false>;
+  return black_white ? collect_result<false, true> : collect_result<false, false>;
+}
+
+static
+void wait_all_steps_completed(const std::shared_ptr<VectorOfStates>& vstate)
+{
+  while (1) {
+    QMutexLocker sleeplock(&h2s_mutex);
+    bool all_steps_completed = true;
+    {
+      QMutexLocker lock2(&vstate->states_mutex);
+      for (int e = 0; e < vstate->nenvs; e++) {
+        std::shared_ptr<State> state = vstate->states[e];
+        QMutexLocker lock3(&state->step_mutex);
+        all_steps_completed &= !state->agent_ready;
+      }
+    }
+    if (all_steps_completed)
+      break;
+    wait_for_step_completed.wait(&h2s_mutex, 1000); // milliseconds
+  }
+}
+
+static
+void vec_wait_all(
+  int handle,
+  bool collect_data,
+  uint8_t* obs_rgb,
+  uint8_t* obs_hires_rgb,
+  uint8_t* obs_audio_seg_map,
+  float* rew,
+  bool* done,
+  bool* new_level)
+{
+  std::shared_ptr<VectorOfStates> vstate = vstate_find(handle);
+  wait_all_steps_completed(vstate);
+  collect_result_fn collect = select_collect_result(collect_data, vstate->black_white);
+  QMutexLocker lock1(&vstate->states_mutex);
+  for (int e = 0; e < vstate->nenvs; e++) {
+    std::shared_ptr<State> state_e = vstate->states[e];
+    {
+      QMutexLocker lock3(&state_e->step_mutex);
+      state_e->result_pending = false;
+    }
+    collect(e, state_e, obs_rgb, obs_hires_rgb, obs_audio_seg_map, rew, done, new_level);
+  }
+}
+
 // ------ C Interface ---------
 
 extern "C" {
@@ -2096,10 +2202,11 @@ void init(int threads)
   }
 }
 
-int vec_create(int nenvs, int lump_n, bool collect_data, float default_zoom)
+int vec_create(int nenvs, int lump_n, bool collect_data, float default_zoom, bool black_white)
 {
   std::shared_ptr<VectorOfStates> vstate(new VectorOfStates);
   vstate->states.resize(nenvs);
+  vstate->black_white = black_white;
 
   for (int n = 0; n < nenvs; n++) {
     vstate->states[n] = std::shared_ptr<State>(new State(vstate));
@@ -2143,27 +2250,50 @@ void vec_close(int handle)
   }
 }
 
+static
+void dispatch_action(const std::shared_ptr<State>& state, int32_t action)
+{
+  assert((unsigned int)action < (unsigned int)NUM_ACTIONS);
+  state->agent.action_dx = DISCRETE_ACTIONS[2 * action + 0];
+  state->agent.action_dy = DISCRETE_ACTIONS[2 * action + 1];
+  {
+    QMutexLocker lock3(&state->step_mutex);
+    // an env must be collected by vec_wait* before it's stepped again, otherwise it would be queued twice
+    assert(!state->result_pending && "env is still stepping, wait for it before stepping it again");
+    state->agent_ready = true;
+    state->result_pending = true;
+    workers_todo.push_back(state);
+  }
+}
+
 void vec_step_async_discrete(int handle, int32_t *actions)
 {
   std::shared_ptr<VectorOfStates> vstate = vstate_find(handle);
   QMutexLocker sleeplock(&h2s_mutex);
   {
     QMutexLocker lock2(&vstate->states_mutex);
-    for (int e = 0; e < vstate->nenvs; e++) {
-      std::shared_ptr<State> state = vstate->states[e];
-      assert((unsigned int)actions[e] < (unsigned int)NUM_ACTIONS);
-      state->agent.action_dx = DISCRETE_ACTIONS[2 * actions[e] + 0];
-      state->agent.action_dy = DISCRETE_ACTIONS[2 * actions[e] + 1];
-      {
-        QMutexLocker lock3(&state->step_mutex);
-        state->agent_ready = true;
-        workers_todo.push_back(state);
-      }
+    for (int e = 0; e < vstate->nenvs; e++)
+      dispatch_action(vstate->states[e], actions[e]);
+  }
+  wait_for_actions.wakeAll();
+}
+
+// Step only the envs listed in env_ids, typically the ones returned by the last vec_wait_batch.
+void vec_step_async_discrete_batch(int handle, int n, int32_t *env_ids, int32_t *actions)
+{
+  std::shared_ptr<VectorOfStates> vstate = vstate_find(handle);
+  QMutexLocker sleeplock(&h2s_mutex);
+  {
+    QMutexLocker lock2(&vstate->states_mutex);
+    for (int i = 0; i < n; i++) {
+      assert((unsigned int)env_ids[i] < (unsigned int)vstate->nenvs);
+      dispatch_action(vstate->states[env_ids[i]], actions[i]);
     }
   }
   wait_for_actions.wakeAll();
 }
 
+// Generic entry point, hires and audio data is copied when both output buffers are given.
 void vec_wait(
   int handle,
   uint8_t* obs_rgb,
@@ -2172,43 +2302,84 @@ void vec_wait(
   float* rew,
   bool* done,
   bool* new_level)
+{
+  bool collect_data = obs_hires_rgb && obs_audio_seg_map && vstate_find(handle)->states[0]->agent.collect_data;
+  vec_wait_all(handle, collect_data, obs_rgb, obs_hires_rgb, obs_audio_seg_map, rew, done, new_level);
+}
+
+// Specialized entry points for envs created without / with collect_data.
+void vec_wait_agent_only(
+  int handle,
+  uint8_t* obs_rgb,
+  float* rew,
+  bool* done,
+  bool* new_level)
+{
+  vec_wait_all(handle, false, obs_rgb, 0, 0, rew, done, new_level);
+}
+
+void vec_wait_with_video(
+  int handle,
+  uint8_t* obs_rgb,
+  uint8_t* obs_hires_rgb,
+  uint8_t* obs_audio_seg_map,
+  float* rew,
+  bool* done,
+  bool* new_level)
+{
+  vec_wait_all(handle, true, obs_rgb, obs_hires_rgb, obs_audio_seg_map, rew, done, new_level);
+}
+
+// Wait until batch_size of the stepped envs are done (or all of them, if fewer are in flight),
+// and write their results into the first slots of the output buffers, in the order given by env_ids.
+// Returns the number of envs written.
+int vec_wait_batch(
+  int handle,
+  int batch_size,
+  int32_t* env_ids,
+  uint8_t* obs_rgb,
+  uint8_t* obs_hires_rgb,
+  uint8_t* obs_audio_seg_map,
+  float* rew,
+  bool* done,
+  bool* new_level)
 {
   std::shared_ptr<VectorOfStates> vstate = vstate_find(handle);
+  std::vector<std::shared_ptr<State>> ready;
   while (1) {
     QMutexLocker sleeplock(&h2s_mutex);
-    bool all_steps_completed = true;
+    int pending = 0;
+    ready.clear();
     {
       QMutexLocker lock2(&vstate->states_mutex);
       for (int e = 0; e < vstate->nenvs; e++) {
         std::shared_ptr<State> state = vstate->states[e];
         QMutexLocker lock3(&state->step_mutex);
-        all_steps_completed &= !state->agent_ready;
+        if (!state->result_pending)
+          continue;
+        pending += 1;
+        if (!state->agent_ready)
+          ready.push_back(state);
       }
     }
-    if (all_steps_completed)
+    if ((int)ready.size() >= std::min(batch_size, pending))
       break;
     wait_for_step_completed.wait(&h2s_mutex, 1000); // milliseconds
   }
+  int n = std::min((int)ready.size(), batch_size);
+  collect_result_fn collect = select_collect_result(
+    obs_hires_rgb && obs_audio_seg_map && vstate->states[0]->agent.collect_data, vstate->black_white);
   QMutexLocker lock1(&vstate->states_mutex);
-  for (int e = 0; e < vstate->nenvs; e++) {
-    std::shared_ptr<State> state_e = vstate->states[e];
-    QMutexLocker lock2(&state_e->state_mutex);
-    // don't really need a mutex, because step is completed, but it's cheap to lock anyway
-    Agent& a = state_e->agent;
-    if (a.collect_data) {
-      copy_render_buf(e, obs_hires_rgb, a.render_hires_buf, VIDEORES, VIDEORES);
-      copy_audio_buf(e, obs_audio_seg_map, a.audio_seg_map_buf, AUDIO_MAP_SIZE);
-    }
-    copy_render_buf(e, obs_rgb, a.render_buf, RES_W, RES_H);
-    
-
-    rew[e] = a.reward;
-    done[e] = a.game_over;
-    new_level[e] = state_e->maze->is_new_level;
-    a.reward = 0;
-    a.game_over = false;
-    state_e->maze->is_new_level = false;
+  for (int i = 0; i < n; i++) {
+    std::shared_ptr<State> state_e = ready[i];
+    {
+      QMutexLocker lock3(&state_e->step_mutex);
+      state_e->result_pending = false;
+    }
+    env_ids[i] = state_e->state_n;
+    collect(i, state_e, obs_rgb, obs_hires_rgb, obs_audio_seg_map, rew, done, new_level);
   }
+  return n;
 }
 
 void coinrun_shutdown()
@@ -2220,6 +2391,8 @@ void coinrun_shutdown()
     th->wait();
     assert(th->isFinished());
   }
+  // allow init() to start a fresh set of stepping threads
+  shutdown_flag = false;
 }
 }
 
@@ -2446,7 +2619,7 @@ extern "C" void test_main_loop()
     app = new QApplication(argc, const_cast<char **>(argv));
   }
 
-  int handle = vec_create(1, 0, false, 5.0);
+  int handle = vec_create(1, 0, false, 5.0, false);
 
   window = new TestWindow();
   window->resize(800, 800);
@@ -10,7 +10,7 @@ import os
 import atexit
 import random
 import sys
-from ctypes import c_int, c_char_p, c_float, c_bool
+from ctypes import c_int, c_char_p, c_float, c_bool, c_void_p
 
 import gym
 import gym.spaces
@@ -30,7 +30,11 @@ DEBUG = False
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 def build():
-    lrank, _lsize = mpi_util.get_local_rank_size(MPI.COMM_WORLD)
+    # a single process has nobody to wait for, so skip the MPI collectives entirely
+    multi_rank = MPI.COMM_WORLD.Get_size() > 1
+    lrank = 0
+    if multi_rank:
+        lrank, _lsize = mpi_util.get_local_rank_size(MPI.COMM_WORLD)
     if lrank == 0:
         dirname = os.path.dirname(__file__)
         if len(dirname):
@@ -42,7 +46,8 @@ def build():
         if r != 0:
             logger.error('coinrun: make failed')
             sys.exit(1)
-    MPI.COMM_WORLD.barrier()
+    if multi_rank:
+        MPI.COMM_WORLD.barrier()
 
 build()
 
@@ -57,33 +62,77 @@ lib.get_NUM_ACTIONS.restype = c_int
 lib.get_RES_W.restype = c_int
 lib.get_RES_H.restype = c_int
 lib.get_VIDEORES.restype = c_int
+lib.get_AUDIO_MAP_SIZE.restype = c_int
+
+# compile-time constants of the game engine, fetched once instead of per CoinRunVecEnv
+NUM_ACTIONS = lib.get_NUM_ACTIONS()
+RES_W = lib.get_RES_W()
+RES_H = lib.get_RES_H()
+VIDEORES = lib.get_VIDEORES()
+AUDIO_MAP_SIZE = lib.get_AUDIO_MAP_SIZE()
 
 lib.vec_create.argtypes = [
     c_int,    # nenvs
     c_int,    # lump_n
     c_bool,   # collect_data
     c_float,  # default_zoom
+    c_bool,   # black_white
     ]
 lib.vec_create.restype = c_int
 
 lib.vec_close.argtypes = [c_int]
 
 lib.vec_step_async_discrete.argtypes = [c_int, npct.ndpointer(dtype=np.int32, ndim=1)]
+lib.vec_step_async_discrete_batch.argtypes = [
+    c_int,                                     # handle
+    c_int,                                     # number of envs to step
+    npct.ndpointer(dtype=np.int32, ndim=1),    # env ids
+    npct.ndpointer(dtype=np.int32, ndim=1),    # actions
+    ]
 
 lib.initialize_args.argtypes = [npct.ndpointer(dtype=np.int32, ndim=1), npct.ndpointer(dtype=np.float32, ndim=1)]
 lib.initialize_set_monitor_dir.argtypes = [c_char_p, c_int]
 
+# The output buffers of vec_wait* are allocated once by CoinRunVecEnv and never
+# reallocated, so they are passed as raw pointers cached at construction time
+# instead of being re-validated by npct.ndpointer on every step.
 lib.vec_wait.argtypes = [
     c_int,
-    npct.ndpointer(dtype=np.uint8, ndim=4),    # smaller rgb for input to agent
-    npct.ndpointer(dtype=np.uint8, ndim=4),    # larger rgb for hires render
-    npct.ndpointer(dtype=np.uint8, ndim=2),    # audio semantic map
-    npct.ndpointer(dtype=np.float32, ndim=1),  # reward
-    npct.ndpointer(dtype=np.bool, ndim=1),     # done
-    npct.ndpointer(dtype=np.bool, ndim=1),     # new_level
+    c_void_p,  # smaller rgb (or luma) for input to agent, uint8 [nenvs, RES_H, RES_W, 3 or 1]
+    c_void_p,  # larger rgb for hires render, uint8 [nenvs, VIDEORES, VIDEORES, 3], NULL unless collecting data
+    c_void_p,  # audio semantic map, uint8 [nenvs, AUDIO_MAP_SIZE], NULL unless collecting data
+    c_void_p,  # reward, float32 [nenvs]
+    c_void_p,  # done, uint8 [nenvs]
+    c_void_p,  # new_level, uint8 [nenvs]
+    ]
+
+# Same as vec_wait, specialized in C on whether hires render and audio data is collected.
+lib.vec_wait_agent_only.argtypes = [
+    c_int,
+    c_void_p,  # smaller rgb (or luma) for input to agent
+    c_void_p,  # reward
+    c_void_p,  # done
+    c_void_p,  # new_level
     ]
 
+lib.vec_wait_with_video.argtypes = lib.vec_wait.argtypes
+
+lib.vec_wait_batch.argtypes = [
+    c_int,
+    c_int,     # batch size
+    c_void_p,  # env ids of the returned envs, int32 [nenvs]
+    c_void_p,  # smaller rgb for input to agent
+    c_void_p,  # larger rgb for hires render
+    c_void_p,  # audio semantic map
+    c_void_p,  # reward
+    c_void_p,  # done
+    c_void_p,  # new_level
+    ]
+lib.vec_wait_batch.restype = c_int
+
 already_inited = False
+num_threads = 0
+live_envs = 0
 
 def init_args_and_threads(cpu_count=4,
                           monitor_csv_policy='all',
@@ -111,19 +160,42 @@ def init_args_and_threads(cpu_count=4,
         os.makedirs(csv_folder)
     lib.initialize_set_monitor_dir(csv_folder.encode('utf-8'), {'off': 0, 'first_env': 1, 'all': 2}[monitor_csv_policy])
 
-    global already_inited
+    global already_inited, num_threads
     if already_inited:
         return
 
     lib.init(cpu_count)
     already_inited = True
+    num_threads = cpu_count
+
+def set_num_threads(cpu_count):
+    """
+    Restart the stepping threads with a different thread count.  Must not be
+    called while a CoinRunVecEnv is between step_async and step_wait.
+    """
+    global already_inited, num_threads
+    if already_inited:
+        lib.coinrun_shutdown()
+    lib.init(cpu_count)
+    already_inited = True
+    num_threads = cpu_count
 
+def restart_threads():
+    global already_inited
+    if already_inited or num_threads == 0:
+        return
+    lib.init(num_threads)
+    already_inited = True
+
+# The stepping threads are normally stopped when the last CoinRunVecEnv is closed.
+# This only catches processes that exit with envs still open.
 @atexit.register
 def shutdown():
     global already_inited
     if not already_inited:
         return
     lib.coinrun_shutdown()
+    already_inited = False
 
 class CoinRunVecEnv(VecEnv):
     """
@@ -138,26 +210,38 @@ class CoinRunVecEnv(VecEnv):
         self.metadata = {'render.modes': []}
         self.reward_range = (-float('inf'), float('inf'))
 
-        self.NUM_ACTIONS = lib.get_NUM_ACTIONS()
-        self.RES_W       = lib.get_RES_W()
-        self.RES_H       = lib.get_RES_H()
-        self.VIDEORES    = lib.get_VIDEORES()
-        self.AUDIO_MAP_SIZE = lib.get_AUDIO_MAP_SIZE()
+        self.NUM_ACTIONS = NUM_ACTIONS
+        self.RES_W       = RES_W
+        self.RES_H       = RES_H
+        self.VIDEORES    = VIDEORES
+        self.AUDIO_MAP_SIZE = AUDIO_MAP_SIZE
 
         self.buf_rew = np.zeros([num_envs], dtype=np.float32)
-        self.buf_done = np.zeros([num_envs], dtype=np.bool)
-        self.buf_new_level = np.zeros([num_envs], dtype=np.bool)
-        self.buf_rgb   = np.zeros([num_envs, self.RES_H, self.RES_W, 3], dtype=np.uint8)
+        # C bool is one byte, so done/new_level are filled as uint8 and handed out
+        # through bool_ views of the same memory
+        self.buf_done = np.zeros([num_envs], dtype=np.uint8)
+        self.buf_new_level = np.zeros([num_envs], dtype=np.uint8)
+        self.done_view = self.buf_done.view(np.bool_)
+        self.new_level_view = self.buf_new_level.view(np.bool_)
+        # with USE_BLACK_WHITE the engine converts observations to luma while copying them out
+        num_channels = 1 if Config.USE_BLACK_WHITE else 3
+        self.buf_rgb   = np.zeros([num_envs, self.RES_H, self.RES_W, num_channels], dtype=np.uint8)
+        self.buf_env_ids = np.zeros([num_envs], dtype=np.int32)
+        self.buf_actions = np.zeros([num_envs], dtype=np.int32)
         
         self.collect_data = Config.COLLECT_DATA
         if self.collect_data:
-            self.buf_render_rgb = np.zeros([num_envs, self.VIDEORES, self.VIDEORES, 3], dtype=np.uint8)
+            render_shape = (num_envs, self.VIDEORES, self.VIDEORES, 3)
+            if Config.RENDER_SHM is not None:
+                self.buf_render_rgb = np.memmap(Config.RENDER_SHM, dtype=np.uint8, mode='w+', shape=render_shape)
+            else:
+                self.buf_render_rgb = np.zeros(render_shape, dtype=np.uint8)
             self.buf_audio_seg_map = np.zeros([num_envs, self.AUDIO_MAP_SIZE], dtype=np.uint8)
         else:
-            self.buf_render_rgb = np.zeros([1, 1, 1, 1], dtype=np.uint8)
-            self.buf_audio_seg_map = np.zeros([1, 1], dtype=np.uint8)
+            # passed to vec_wait as NULL, the C side only fills these when collecting data
+            self.buf_render_rgb = None
+            self.buf_audio_seg_map = None
 
-        num_channels = 1 if Config.USE_BLACK_WHITE else 3
         obs_space = gym.spaces.Box(0, 255, shape=[self.RES_H, self.RES_W, num_channels], dtype=np.uint8)
 
         super().__init__(
@@ -165,22 +249,51 @@ class CoinRunVecEnv(VecEnv):
             observation_space=obs_space,
             action_space=gym.spaces.Discrete(self.NUM_ACTIONS),
             )
+        # the stepping threads are stopped when the last env closes, start them again if needed
+        restart_threads()
+        global live_envs
+        live_envs += 1
+
         self.handle = lib.vec_create(
             self.num_envs,
             lump_n,
             self.collect_data,
-            default_zoom)
+            default_zoom,
+            bool(Config.USE_BLACK_WHITE))
         self.dummy_info = [{} for _ in range(num_envs)]
 
+        self._wait_ptrs = [None if buf is None else buf.ctypes.data_as(c_void_p) for buf in (
+            self.buf_rgb,
+            self.buf_render_rgb,
+            self.buf_audio_seg_map,
+            self.buf_rew,
+            self.buf_done,
+            self.buf_new_level,
+            )]
+        self._env_ids_ptr = self.buf_env_ids.ctypes.data_as(c_void_p)
+
+        if self.collect_data:
+            self._vec_wait = lib.vec_wait_with_video
+            self._vec_wait_ptrs = self._wait_ptrs
+        else:
+            self._vec_wait = lib.vec_wait_agent_only
+            self._vec_wait_ptrs = [self._wait_ptrs[0]] + self._wait_ptrs[3:]
+
     def __del__(self):
         if hasattr(self, 'handle'):
-            lib.vec_close(self.handle)
-        self.handle = 0
+            self.close()
 
     def close(self):
+        if self.handle == 0:
+            return
         lib.vec_close(self.handle)
         self.handle = 0
 
+        global live_envs
+        live_envs -= 1
+        if live_envs == 0:
+            shutdown()
+
     def reset(self):
         obs, _, _, _, _, _, r = self.step_wait()
         return obs
@@ -192,30 +305,48 @@ class CoinRunVecEnv(VecEnv):
             return self.buf_rgb
 
     def step_async(self, actions):
-        assert actions.dtype in [np.int32, np.int64]
-        actions = actions.astype(np.int32)
-        lib.vec_step_async_discrete(self.handle, actions)
+        lib.vec_step_async_discrete(self.handle, self._int32_actions(actions))
 
     def step_wait(self):
-        self.buf_rew = np.zeros_like(self.buf_rew)
-        self.buf_done = np.zeros_like(self.buf_done)
-        self.buf_new_level = np.zeros_like(self.buf_new_level)
-
-        lib.vec_wait(
-            self.handle,
-            self.buf_rgb,
-            self.buf_render_rgb,
-            self.buf_audio_seg_map,
-            self.buf_rew,
-            self.buf_done,
-            self.buf_new_level)
+        # vec_wait overwrites every entry of rew/done/new_level, so the buffers are
+        # reused in place across steps. Callers that keep them around must copy.
+        self._vec_wait(self.handle, *self._vec_wait_ptrs)
+
+        return self.buf_rgb, self.buf_rew, self.done_view, self.dummy_info, self.buf_render_rgb, self.buf_audio_seg_map, self.new_level_view
+
+    def step_async_batch(self, env_ids, actions):
+        """
+        Step only the environments in `env_ids`, usually the ones returned by the
+        previous `step_wait_batch`. The other environments keep running, and must
+        not be passed again until a `step_wait_batch` has returned them.
+        """
+        env_ids = np.asarray(env_ids, dtype=np.int32)
+        assert len(env_ids) == len(actions)
+        lib.vec_step_async_discrete_batch(self.handle, len(env_ids), env_ids, self._int32_actions(actions))
+
+    def step_wait_batch(self, batch_size):
+        """
+        Wait for `batch_size` of the stepping environments to finish (all of them if
+        fewer are in flight) and return their env ids along with the usual step results.
+        Row i of each result belongs to environment `env_ids[i]`.
+        """
+        n = lib.vec_wait_batch(self.handle, batch_size, self._env_ids_ptr, *self._wait_ptrs)
+
+        render_rgb, audio_seg_map = self.buf_render_rgb, self.buf_audio_seg_map
+        if self.collect_data:
+            render_rgb, audio_seg_map = render_rgb[:n], audio_seg_map[:n]
 
-        obs_frames = self.buf_rgb
+        return self.buf_env_ids[:n], self.buf_rgb[:n], self.buf_rew[:n], self.done_view[:n], self.dummy_info[:n], render_rgb, audio_seg_map, self.new_level_view[:n]
 
-        if Config.USE_BLACK_WHITE:
-            obs_frames = np.mean(obs_frames, axis=-1).astype(np.uint8)[...,None]
+    def _int32_actions(self, actions):
+        assert actions.dtype in [np.int32, np.int64]
+        if actions.dtype == np.int32 and actions.flags.c_contiguous:
+            return actions
 
-        return obs_frames, self.buf_rew, self.buf_done, self.dummy_info, self.buf_render_rgb, self.buf_audio_seg_map, self.buf_new_level
+        # int64 actions from the policy are narrowed into a persistent buffer instead of a fresh array
+        buf = self.buf_actions[:len(actions)]
+        np.copyto(buf, actions, casting='unsafe')
+        return buf
 
 def make(num_envs, **kwargs):
     return CoinRunVecEnv(num_envs, **kwargs)
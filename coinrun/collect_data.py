@@ -15,6 +15,9 @@ from coinrun import policies, wrappers
 import copy
 
 import os
+import queue
+import subprocess
+import threading
 import cv2
 import numpy as np
 from sys import platform
@@ -25,32 +28,75 @@ if can_render:
 
 class DataCollector:
     def __init__(self):
+        from coinrun.coinrunenv import AUDIO_MAP_SIZE
+
         self.run_identifier = 'model_' + Config.RESTORE_ID + '_seed_' + str(Config.SET_SEED)
-        self.save_audio_seg_map_path = os.path.join(Config.SAVE_DIR, self.run_identifier, 'audio_semantic_map', 'audio_map.txt')
+        # audio maps are stored as raw uint8 rows in audio_map.bin, audio_map_index.txt has the
+        # row size and the first row of every level (see load_audio_map in gen_videos.py)
+        self.save_audio_seg_map_path = os.path.join(Config.SAVE_DIR, self.run_identifier, 'audio_semantic_map', 'audio_map.bin')
+        self.save_audio_seg_map_index_path = os.path.join(os.path.dirname(self.save_audio_seg_map_path), 'audio_map_index.txt')
+
+        os.makedirs(os.path.dirname(self.save_audio_seg_map_path), exist_ok=True)
 
-        if not os.path.exists(Config.SAVE_DIR):
-            os.mkdir(Config.SAVE_DIR)
-        if not os.path.exists(os.path.join(Config.SAVE_DIR, self.run_identifier)):
-            os.mkdir(os.path.join(Config.SAVE_DIR, self.run_identifier))
-        if not os.path.exists(os.path.dirname(self.save_audio_seg_map_path)):
-            os.mkdir(os.path.dirname(self.save_audio_seg_map_path))
+        for path in [self.save_audio_seg_map_path, self.save_audio_seg_map_index_path]:
+            if os.path.exists(path):
+                os.remove(path)
 
-        if os.path.exists(self.save_audio_seg_map_path):
-            os.remove(self.save_audio_seg_map_path)
+        self.video_dir = os.path.join(Config.SAVE_DIR, self.run_identifier, 'videos')
+        if Config.VIDEO_OUT:
+            os.makedirs(self.video_dir, exist_ok=True)
+        self.video_proc = None
 
         self.level_num = 0
         self.frame_num = 0
+        self.total_frames = 0
         self.num_levels_to_collect = Config.NUM_LEVELS_TO_COLLECT
 
-        with open(self.save_audio_seg_map_path, "a") as f:
-            f.write("level_{:04d}\n".format(self.level_num))
-         
+        # audio maps are written by a background thread so disk I/O stays off the env loop
+        self.audio_seg_map_file = open(self.save_audio_seg_map_path, "wb")
+        self.audio_seg_map_index_file = open(self.save_audio_seg_map_index_path, "w")
+        self.write_queue = queue.Queue(maxsize=1024)
+        self.writer_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer_thread.start()
+
+        self.write_queue.put("audio_map_size,{}\n".format(AUDIO_MAP_SIZE))
+        self.write_queue.put("level_{:04d},{}\n".format(self.level_num, self.total_frames))
+
+    def _write_loop(self):
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                break
+            if isinstance(item, str):
+                self.audio_seg_map_index_file.write(item)
+            else:
+                self.audio_seg_map_file.write(item.tobytes())
 
     def save_frame_info(self, audio_seg_map_array):
-        with open(self.save_audio_seg_map_path, "a") as f:
-            f.write(','.join([str(s) for s in audio_seg_map_array]) + "\n")
+        # copy since the env reuses its audio map buffer on the next step
+        self.write_queue.put(np.array(audio_seg_map_array, dtype=np.uint8))
 
         self.frame_num += 1
+        self.total_frames += 1
+
+    def save_frame_video(self, frame):
+        # raw rgb frames are piped to ffmpeg, which encodes in its own process
+        if self.video_proc is None:
+            h, w = frame.shape[:2]
+            video_path = os.path.join(self.video_dir, "level_{:04d}.mp4".format(self.level_num))
+            self.video_proc = subprocess.Popen([
+                'ffmpeg', '-y', '-loglevel', 'error',
+                '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(w, h), '-r', '30', '-i', '-',
+                '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', video_path,
+            ], stdin=subprocess.PIPE)
+
+        self.video_proc.stdin.write(np.ascontiguousarray(frame).data)
+
+    def close_video(self):
+        if self.video_proc is not None:
+            self.video_proc.stdin.close()
+            self.video_proc.wait()
+            self.video_proc = None
 
     def should_continue(self):
         return self.level_num < self.num_levels_to_collect
@@ -58,9 +104,16 @@ class DataCollector:
     def new_level(self):
         self.level_num += 1
         self.frame_num = 0
+        self.close_video()
 
-        with open(self.save_audio_seg_map_path, "a") as f:
-            f.write("level_{:04d}\n".format(self.level_num))
+        self.write_queue.put("level_{:04d},{}\n".format(self.level_num, self.total_frames))
+
+    def close(self):
+        self.close_video()
+        self.write_queue.put(None)
+        self.writer_thread.join()
+        self.audio_seg_map_file.close()
+        self.audio_seg_map_index_file.close()
 
 
 def create_act_model(sess, env, nenvs):
@@ -102,10 +155,15 @@ def run_env_sess(sess):
 
 
         data_collector.save_frame_info(audio_seg_map[0,:])
+        if Config.VIDEO_OUT:
+            data_collector.save_frame_video(high_res_render[0])
         curr_rews += rew[0]
         if can_render:
             viewer.imshow(high_res_render[0,:,:,-3:])
 
+    data_collector.close()
+    env.close()
+
 def main():
     tf.set_random_seed(2) # to ensure reproducibility of agent
     utils.setup_mpi_gpus()
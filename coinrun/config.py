@@ -38,6 +38,11 @@ class ConfigSingle(object):
         # The number of parallel environments to run
         type_keys.append(('ne', 'num_envs', int, 32, True))
 
+        # The number of game engine threads stepping the environments
+        # If NUM_THREADS = 0, pick the fastest thread count with a short warmup benchmark (see vec_factory.py),
+        # except with set_seed or collect_data, where 4 threads are used so the levels and csv files are unaffected
+        type_keys.append(('nt', 'num_threads', int, 4))
+
         # The number of levels in the training set.
         # If NUM_LEVELS = 0, the training set is unbounded. All level seeds will be randomly generated.
         # Use SET_SEED = -1 and NUM_LEVELS = 500 to train with the same levels in the paper.
@@ -63,6 +68,17 @@ class ConfigSingle(object):
         type_keys.append(('level-timeout', 'level_timeout', int, 1000))
         bool_keys.append(('collect_data', 'collect_data'))
 
+        # Should the hires frames be encoded to one mp4 per level while collecting data
+        bool_keys.append(('video_out', 'video_out'))
+
+        # File to back the hires render buffer with when collecting data (e.g. under /dev/shm),
+        # so that another process can np.memmap it and read frames without a copy through Python
+        type_keys.append(('render-shm', 'render_shm', str, None))
+
+        # String values are parsed with '-' replaced by '_' (see parse_args_dict), except for these file and
+        # directory paths, which are kept as given (e.g. /dev/shm/coinrun-render)
+        self.PATH_KEYS = ['save_dir', 'render_shm']
+
         # Agent Reward Config
         type_keys.append(('air-control', 'air_control', float, 0.15))
         type_keys.append(('bump-head-penalty', 'bump_head_penalty', float, 0.0))
@@ -183,7 +199,7 @@ class ConfigSingle(object):
         for ak in self.args_dict:
             val = self.args_dict[ak]
 
-            if isinstance(val, str):
+            if isinstance(val, str) and ak not in self.PATH_KEYS:
                 val = self.process_field(val)
 
             setattr(self, ak.upper(), val)
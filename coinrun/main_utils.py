@@ -12,9 +12,12 @@ from coinrun import setup_utils, wrappers
 import platform
 
 def make_general_env(num_env, seed=0, use_sub_proc=True):
-    from coinrun import coinrunenv
+    from coinrun import coinrunenv, vec_factory
     
-    env = coinrunenv.make(num_env)
+    if Config.NUM_THREADS == 0:
+        env = vec_factory.make_auto(num_env)
+    else:
+        env = coinrunenv.make(num_env)
 
     if Config.FRAME_STACK > 1:
         env = VecFrameStack(env, Config.FRAME_STACK)
@@ -141,6 +144,8 @@ def mpi_average(values):
     return mpi_average_comm(values, MPI.COMM_WORLD)
 
 def mpi_average_comm(values, comm):
+    # blocking collective, only called once per log interval. Anything reduced per env step
+    # should be batched over many steps and use comm.Iallreduce instead.
     size = comm.size
 
     x = np.array(values)
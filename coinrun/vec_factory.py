@@ -0,0 +1,71 @@
+"""
+Create a CoinRunVecEnv with the number of game engine threads picked by a short warmup benchmark.
+The fastest thread count depends on the machine and on whether hires data is being collected.
+
+Copyright (c) Meta Platforms, Inc. All Right reserved.
+"""
+
+import os
+import time
+
+import numpy as np
+from baselines import logger
+
+from coinrun import coinrunenv
+from coinrun.config import Config
+
+
+def candidate_thread_counts():
+    max_threads = os.cpu_count() or 4
+    counts = [1]
+    while counts[-1] * 2 <= max_threads:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != max_threads:
+        counts.append(max_threads)
+    return counts
+
+
+def measure_steps_per_second(env, num_steps):
+    env.reset()
+    start = time.time()
+    for _ in range(num_steps):
+        actions = np.random.randint(env.NUM_ACTIONS, size=env.num_envs).astype(np.int32)
+        env.step_async(actions)
+        env.step_wait()
+    return num_steps * env.num_envs / (time.time() - start)
+
+
+def make_auto(num_envs, thread_counts=None, num_steps=200, **kwargs):
+    """
+    Benchmark each of `thread_counts` (powers of two up to the cpu count by default) for
+    `num_steps` steps, then return a fresh CoinRunVecEnv running with the fastest one.
+
+    Each thread count restarts the engine threads, and coinrun_shutdown can block for up to
+    about 1s per restart while the threads notice the shutdown flag.
+
+    Auto-tuning is skipped when SET_SEED is used or COLLECT_DATA is on: the benchmark steps
+    draw level seeds from the engine's global random generator, so the real env would not
+    see the levels the seed promises, and the benchmark envs write to the same monitor csv
+    files the collected data is built from. The thread count set at init is used instead.
+    """
+    if Config.SET_SEED != -1 or Config.COLLECT_DATA:
+        logger.info('coinrun: not auto-tuning engine threads with set_seed or collect_data, using %i threads' % (
+            coinrunenv.num_threads))
+        return coinrunenv.make(num_envs, **kwargs)
+
+    if thread_counts is None:
+        thread_counts = candidate_thread_counts()
+
+    env = coinrunenv.make(num_envs, **kwargs)
+    results = {}
+    for num_threads in thread_counts:
+        coinrunenv.set_num_threads(num_threads)
+        results[num_threads] = measure_steps_per_second(env, num_steps)
+    env.close()
+
+    best = max(results, key=results.get)
+    logger.info('coinrun: steps/sec by engine thread count %s, using %i threads' % (
+        ', '.join('%i: %.0f' % (n, results[n]) for n in thread_counts), best))
+
+    coinrunenv.set_num_threads(best)
+    return coinrunenv.make(num_envs, **kwargs)
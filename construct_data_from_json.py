@@ -24,10 +24,16 @@ To generate original color frame instead of semantic maps, add argument:
 """
 
 import argparse
+import functools
 import imageio
 import math
+import multiprocessing
 import numpy as np
 import os
+import queue
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from PIL import Image
 
@@ -35,11 +41,18 @@ from convert_csv_to_json import Game
 
 ASSET_ROOT = 'coinrun/assets'
 
+# hardware h264 encoders tried in order by --video_codec auto, before falling back to libx264
+HW_VIDEO_CODECS = ['h264_nvenc', 'h264_videotoolbox', 'h264_qsv']
+
 # TODO: save these from the game engine? would they ever change?
 DEATH_ANIM_LENGTH = 30
 FINISHED_LEVEL_ANIM_LENGTH = 20
 MONSTER_DEATH_ANIM_LENGTH = 3
 
+# suffixes of monster asset names, indexed by pose (0 walk1, 1 move, 2 dead) and facing (0 left, 1 right)
+MONSTER_POSES = ['', '_move', '_dead']
+MONSTER_FACINGS = ['', '_right']
+
 # constant symbols for the maze used in game engine
 SPACE = '.'
 LADDER = '='
@@ -59,6 +72,8 @@ CRATE_WARNING = '%'
 
 
 # color names from: https://www.rapidtables.com/web/color/RGB_Color.html#color-table
+# NOTE: the returned map is cached and shared between callers, don't modify it
+@functools.lru_cache(maxsize=None)
 def define_semantic_color_map(single_channel_label=False, readable_label=False):
     semantic_color_map = {}
 
@@ -237,27 +252,29 @@ def generate_asset_paths(game):
     return asset_files
 
 
-# binarize alpha channel if input img is in RGBA mode, set anything above 0 to 255
-def binarize_alpha_channel(img):
-    if img.mode != 'RGBA':
-        return img
+# 3 channel semantic maps are drawn as palette indices and only converted to RGB at the end,
+# this maps each semantic color to its index (0 is the black background)
+semantic_palette = {(0, 0, 0): 0}
 
-    w, h = img.size
-    for i in range(w):
-        for j in range(h):
-            pixel = img.getpixel((i, j))
 
-            # set alpha to 255 if alpha > 0
-            if pixel[3] > 0:
-                img.putpixel((i, j), (pixel[0], pixel[1], pixel[2], 255))
+def get_semantic_palette_index(color):
+    if color not in semantic_palette:
+        assert len(semantic_palette) < 256, 'too many semantic colors for a palette'
+        semantic_palette[color] = len(semantic_palette)
+    return semantic_palette[color]
 
-    return img
+
+def get_semantic_palette_bytes():
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    for color, index in semantic_palette.items():
+        palette[index] = color
+    return palette.tobytes()
 
 
 class Asset:
     def __init__(
         self, name, file, kind='world', kx=80, ky=80,
-        semantic_color=(0, 0, 0), flip=False, binarize_alpha=False
+        semantic_color=(0, 0, 0), flip=False
     ):
         self.name = name
         self.file = file
@@ -265,44 +282,79 @@ class Asset:
         self.kx = kx
         self.ky = ky
         self.semantic_color = semantic_color
+        # single byte label painted into semantic maps, for 3 channel colors an index into the semantic palette
+        if isinstance(semantic_color, tuple):
+            self.label = get_semantic_palette_index(semantic_color)
+        else:
+            self.label = semantic_color
         self.flip = flip
-        self.binarize_alpha = binarize_alpha
         
         self.load_asset()
     
     def load_asset(self):
-        asset_path = os.path.join(ASSET_ROOT, self.file)
-        assert os.path.isfile(asset_path), asset_path
-        self.asset = Image.open(asset_path)
-        
-        # used for (user control) asset swap, because alien h:w == 2:1 while others is 1:1
-        # the asset resize at loading and render grid size all need to change respectively
-        self.aspect_ratio = self.asset.size[1] / self.asset.size[0]
-
-        # TODO: check if ceil is needed
-        if self.kind == 'world':
-            if self.name != LAVA_MIDDLE and self.name != LAVA_SURFACE:
-                # LAVA has a special way of rendering animation so don't resize now
-                self.asset = self.asset.resize((math.ceil(self.kx + .5), math.ceil(self.ky + .5)))
-        elif self.kind == 'alien':
-            self.asset = self.asset.resize((math.ceil(self.kx), math.ceil(self.aspect_ratio * self.ky)))
-        elif self.kind == 'shield':
-            # TODO: magic number hard-coded for shield asset rendering size, this won't work for user-input character
-            # we need either a way to draw shield on-the-fly based on character,
-            # or automatic resizing of shield based on aspect ratio
-            self.asset = self.asset.resize((math.ceil(self.kx * 1.15), math.ceil(self.ky * 2.1)))
-        elif self.kind == 'monster' or self.kind == 'background':
-            self.asset = self.asset.resize((math.ceil(self.kx), math.ceil(self.ky)))
-        else:
-            raise NotImplementedError(f"Unknown asset kind {self.kind}")
-        
-        # flip if needed (for facing left/right)
-        if self.flip:
-            self.asset = self.asset.transpose(Image.FLIP_LEFT_RIGHT)
+        self.load_key = (self.name, self.file, self.kind, self.kx, self.ky, self.flip)
+        self.asset, self.aspect_ratio = load_asset_image(*self.load_key)
+        # plain python copies of the image properties used while rendering
+        self.size = self.asset.size
+        self.width, self.height = self.size
+        self.mode = self.asset.mode
+        self.is_rgba = self.mode == 'RGBA'
+
+    # boolean paint mask of the asset at the given render size, for semantic maps
+    def get_alpha_mask(self, w, h):
+        return load_alpha_mask(self.load_key, w, h)
+
+
+# loaded assets only depend on these arguments, so they are cached and shared by all
+# Asset objects (e.g. across levels that use the same themes and zoom)
+# NOTE: the returned image is shared, don't modify it in place
+@functools.lru_cache(maxsize=1024)
+def load_asset_image(name, file, kind, kx, ky, flip):
+    asset_path = os.path.join(ASSET_ROOT, file)
+    assert os.path.isfile(asset_path), asset_path
+    asset = Image.open(asset_path)
+    # decode now: Image.open is lazy and the cached image is shared by render threads,
+    # which would otherwise race to load unresized assets (lava) on first use
+    asset.load()
+
+    # used for (user control) asset swap, because alien h:w == 2:1 while others is 1:1
+    # the asset resize at loading and render grid size all need to change respectively
+    aspect_ratio = asset.size[1] / asset.size[0]
+
+    # TODO: check if ceil is needed
+    if kind == 'world':
+        if name != LAVA_MIDDLE and name != LAVA_SURFACE:
+            # LAVA has a special way of rendering animation so don't resize now
+            asset = asset.resize((math.ceil(kx + .5), math.ceil(ky + .5)))
+    elif kind == 'alien':
+        asset = asset.resize((math.ceil(kx), math.ceil(aspect_ratio * ky)))
+    elif kind == 'shield':
+        # TODO: magic number hard-coded for shield asset rendering size, this won't work for user-input character
+        # we need either a way to draw shield on-the-fly based on character,
+        # or automatic resizing of shield based on aspect ratio
+        asset = asset.resize((math.ceil(kx * 1.15), math.ceil(ky * 2.1)))
+    elif kind == 'monster' or kind == 'background':
+        asset = asset.resize((math.ceil(kx), math.ceil(ky)))
+    else:
+        raise NotImplementedError(f"Unknown asset kind {kind}")
+
+    # flip if needed (for facing left/right)
+    if flip:
+        asset = asset.transpose(Image.FLIP_LEFT_RIGHT)
+
+    # NOTE: alpha is not binarized here. semantic maps threshold alpha > 0 of the resized asset in
+    # get_alpha_mask, which is the same as binarizing after this resize (and commutes with the
+    # nearest resize / crops applied later), without an extra pass over every asset
+    return asset, aspect_ratio
+
 
-        # NOTE: this must happen in the end, or resize will result in new intepolated alpha value!!
-        if self.binarize_alpha:
-            self.asset = binarize_alpha_channel(self.asset)
+# boolean masks used to paint semantic maps, one per loaded asset and render size.
+# like the images, they are shared by all Asset objects loaded with the same arguments,
+# so rebuilding the asset map for another level reuses them.
+# assets don't share a common size (alien is 2:1, lava isn't resized), so they're not stacked in one array
+@functools.lru_cache(maxsize=4096)
+def load_alpha_mask(load_key, w, h):
+    return get_alpha_mask(load_asset_image(*load_key)[0], w, h)
 
 
 def load_assets(asset_files, semantic_color_map, kx=80, ky=80, gen_original=False):
@@ -320,20 +372,17 @@ def load_assets(asset_files, semantic_color_map, kx=80, ky=80, gen_original=Fals
             asset_map[kind] = Asset(
                 name=kind, file=asset_files[kind], kind=kind,
                 kx=kx, ky=ky, semantic_color=semantic_color_map[kind],
-                binarize_alpha=not gen_original,
             )
             continue
 
-        # NOTE: if not generating original, binarize alpha channel of all assets
-        # this is a bit slow (~1s) but only run once at init
-        # an alternative is to pre-binarize another copy of assets for semantic maps
+        # NOTE: semantic maps paint every asset pixel with alpha > 0 as opaque, see get_alpha_mask
+        # loaded assets are cached (see load_asset_image), so this only runs once per process
         for key in asset_files[kind].keys():
             if kind == 'world':
                 # ground asset, no need to worry about pose or facing
                 asset_map[key] = Asset(
                     name=key, file=asset_files[kind][key], kind=kind,
                     kx=kx, ky=ky, semantic_color=semantic_color_map[kind][key],
-                    binarize_alpha=not gen_original,
                 )
             elif kind == 'alien':
                 # facing right is default to empty
@@ -346,13 +395,12 @@ def load_assets(asset_files, semantic_color_map, kx=80, ky=80, gen_original=Fals
                         name=a_key, file=asset_files[kind][key], kind=kind,
                         kx=kx, ky=ky, semantic_color=semantic_color_map[kind],
                         flip=(facing != ''),    # flip the asset if facing is not ''
-                        binarize_alpha=not gen_original,
                     )
             elif kind == 'monster':
                 # for monsters, 3 types of assets will be loaded
                 # for each of them, facing can be left or right
-                all_poses = ['', '_move', '_dead']       # walk1 is default to empty
-                all_facings = ['', '_right']             # facing left is default to empty
+                all_poses = MONSTER_POSES        # walk1 is default to empty
+                all_facings = MONSTER_FACINGS    # facing left is default to empty
                 base_fn = os.path.splitext(asset_files[kind][key])[0]   # e.g. Enemies/bee
                 for pose in all_poses:
                     for facing in all_facings:
@@ -363,7 +411,6 @@ def load_assets(asset_files, semantic_color_map, kx=80, ky=80, gen_original=Fals
                             name=m_key, file=file_name, kind='monster',
                             kx=kx, ky=ky, semantic_color=semantic_color_map[kind][key],
                             flip=(facing != ''),    # flip the asset if facing is not ''
-                            binarize_alpha=not gen_original,
                         )
             else:
                 raise NotImplementedError(f"Unknown asset kind {kind}")
@@ -384,60 +431,54 @@ def load_bg_asset(asset_files, semantic_color_map, zx, zy):
 # used for alien dying animation in gen_original mode
 def get_transparent_asset(input_asset, transparency):
     assert input_asset.mode == 'RGBA'
-    np_asset = np.array(input_asset, dtype=np.int16)
-    np_asset[:, :, 3] -= transparency
-    np_asset[:, :, 3] = np.clip(np_asset[:, :, 3], 0, None)
-    return Image.fromarray(np_asset.astype(np.uint8))
+    np_asset = np.array(input_asset)
+    # saturating subtract on the uint8 alpha channel, in place
+    alpha = np_asset[:, :, 3]
+    visible = alpha > transparency
+    np.subtract(alpha, min(transparency, 255), out=alpha, where=visible, casting='unsafe')
+    alpha[~visible] = 0
+    return Image.fromarray(np_asset, 'RGBA')
 
 
-# return rect in integer values, floor for x1,y1, ceil for x2,y2 or w,h
-def integer_rect(rect):
-    return [math.floor(rect[0]), math.floor(rect[1]), math.ceil(rect[2]), math.ceil(rect[3])]
+# transparency only takes ~DEATH_ANIM_LENGTH distinct values, so the faded assets are
+# cached per (Asset, transparency) and reused across frames and levels
+@functools.lru_cache(maxsize=256)
+def get_cached_transparent_asset(asset, transparency):
+    return get_transparent_asset(asset.asset, transparency)
 
 
 def convert_xywh_to_xyxy(rect):
     return [rect[0], rect[1], rect[0] + rect[2], rect[1] + rect[3]]
 
 
-def convert_xyxy_to_xywh(rect):
-    return [rect[0], rect[1], rect[2] - rect[0], rect[3] - rect[1]]
-
-
-# rect format is xywh, img_size is (w,h)
-def check_out_of_bounds(rect, img_size):
-    if rect[0] + rect[2] < 0:
-        return True
-    if rect[0] > img_size[0]:
-        return True
-    if rect[1] + rect[3] < 0:
-        return True
-    if rect[1] > img_size[1]:
-        return True
-    return False
-
-
-# return intersect of two rects, input and output are both in xywh format
-def intersect_rects(rect1, rect2):
-    xyxy_rect1 = convert_xywh_to_xyxy(rect1)
-    xyxy_rect2 = convert_xywh_to_xyxy(rect2)
-    xyxy_res_rect = [
-        max(xyxy_rect1[0], xyxy_rect2[0]),
-        max(xyxy_rect1[1], xyxy_rect2[1]),
-        min(xyxy_rect1[2], xyxy_rect2[2]),
-        min(xyxy_rect1[3], xyxy_rect2[3])
-    ]
-
-    xywh_res_rect = convert_xyxy_to_xywh(xyxy_res_rect)
-
-    # check if the intersection is empty
-    if xywh_res_rect[2] > 0 and xywh_res_rect[3] > 0:
-        return xywh_res_rect
-    else:
+# resize mask image to (w, h) the same way as for semantic maps and return where it's painted
+# as a boolean array, or None if the whole rect is painted (no alpha channel)
+def get_alpha_mask(mask, w, h):
+    if mask.size != (w, h):
+        mask = mask.resize((w, h), resample=Image.NEAREST)
+    if mask.mode != 'RGBA':
         return None
+    return np.asarray(mask)[:, :, 3] > 0
 
 
 # rect is in the format of xywh
+# semantic maps are drawn into a numpy array, in which case mask is the boolean array from get_alpha_mask
 def paint_color_in_rect_with_mask(img, rect, color, mask, gen_original=False):
+    if isinstance(img, np.ndarray):
+        # fill the part of rect inside the image with color where mask is set
+        x0, y0 = max(rect[0], 0), max(rect[1], 0)
+        x1, y1 = min(rect[0] + rect[2], img.shape[1]), min(rect[1] + rect[3], img.shape[0])
+        if x0 >= x1 or y0 >= y1:
+            return
+        if mask is None:
+            img[y0:y1, x0:x1] = color
+            return
+        if x1 - x0 != rect[2] or y1 - y0 != rect[3]:
+            mask = mask[y0 - rect[1]:y1 - rect[1], x0 - rect[0]:x1 - rect[0]]
+        # putmask is a single C loop over the rect, faster than boolean index assignment
+        np.putmask(img[y0:y1, x0:x1], mask, color)
+        return
+
     w, h = mask.size
     img_w, img_h = img.size
     # in some cases, mask size doesn't match the rect (e.g. monster dying)
@@ -461,15 +502,111 @@ def paint_color_in_rect_with_mask(img, rect, color, mask, gen_original=False):
     return
 
 
+# part of [start, start + length) inside [other_start, other_start + other_length) as (start, length), None if empty
+def clip_span(start, length, other_start, other_length):
+    x0 = max(start, other_start)
+    x1 = min(start + length, other_start + other_length)
+    if x1 > x0:
+        return x0, x1 - x0
+    return None
+
+
+@functools.lru_cache(maxsize=256)
+def get_asset_crop(asset, box):
+    return asset.asset.crop(box)
+
+
+@functools.lru_cache(maxsize=256)
+def get_lava_crop_alpha_mask(asset, box, size):
+    return get_alpha_mask(get_asset_crop(asset, box), size[0], size[1])
+
+
+# lava is drawn as two halves of the asset split at the scroll phase, each resized into its part of the
+# tile rect [x, y, w, h] on its own. resampling a pre-shifted lava frame instead would change most color
+# pixels and move the seam in semantic maps, so this keeps both reproducible
+def paint_lava(img, rect, asset, phase, gen_original=False):
+    x, y, w, h = rect
+    aw, ah = asset.size
+    dh = (y + h) - y
+    # the right part of the asset scrolls to the left of the tile, the left part follows it
+    for dst_start, src_start, pad_left in ((x - phase * w, phase * aw, 0.0), (x + w - phase * w, -aw + phase * aw, 0.5)):
+        dst = clip_span(dst_start, w, x, w)
+        src = clip_span(src_start, aw, 0, aw)
+        if dst is None or src is None:
+            continue
+        box = (math.floor(src[0]), 0, math.ceil(src[0] + src[1]), math.ceil(ah))
+        dst_rect = [math.floor(dst[0] - pad_left), math.floor(y), math.ceil(dst[1] + 0.5), math.ceil(dh)]
+        if isinstance(img, np.ndarray):
+            mask = get_lava_crop_alpha_mask(asset, box, (dst_rect[2], dst_rect[3]))
+        else:
+            mask = get_asset_crop(asset, box)
+        paint_color_in_rect_with_mask(img, dst_rect, asset.label, mask, gen_original=gen_original)
+
+
+# the maze as a 2D array of characters, cached on the game object until its maze changes
+def get_maze_array(game):
+    if getattr(game, 'maze_array_src', None) is not game.maze:
+        game.maze_array = np.array([list(row) for row in game.maze])
+        game.maze_array_src = game.maze
+    return game.maze_array
+
+
+# empty canvas that draw_game_frame draws into, an RGB image for gen_original or an array of labels
+def new_frame_canvas(game, gen_original=False):
+    if gen_original:
+        return Image.new('RGB', (game.video_res, game.video_res))
+    return np.zeros((game.video_res, game.video_res), dtype=np.uint8)
+
+
+# per-monster values used for rendering as arrays. they're cached per frame (until its monsters change)
+# in a dict on the game object, which is reset when the game's frames are replaced, e.g. by loading another level
+def get_monster_arrays(game, frame):
+    if getattr(game, 'monster_arrays_src', None) is not game.frames:
+        game.monster_arrays = {}
+        game.monster_arrays_src = game.frames
+    cached = game.monster_arrays.get(frame)
+    if cached is None or cached[0] is not frame.monsters:
+        cached = (frame.monsters, {
+            'x': np.array([m.x for m in frame.monsters], dtype=np.float64),
+            'y': np.array([m.y for m in frame.monsters], dtype=np.float64),
+            'is_dead': np.array([m.is_dead for m in frame.monsters], dtype=bool),
+            'dying_frame_cnt': np.array([m.monster_dying_frame_cnt for m in frame.monsters], dtype=np.int64),
+            'theme': np.array([m.theme for m in frame.monsters], dtype=np.int64),
+            'walk1_mode': np.array([m.walk1_mode for m in frame.monsters], dtype=bool),
+            'vx': np.array([m.vx for m in frame.monsters], dtype=np.float64),
+        })
+        game.monster_arrays[frame] = cached
+    return cached[1]
+
+
+# monster asset keys indexed by [theme][pose][facing], cached on the game object
+def get_monster_asset_keys(game):
+    if getattr(game, 'monster_asset_keys_src', None) != game.flattened_monster_names:
+        game.monster_asset_keys = [
+            [[name + pose + facing for facing in MONSTER_FACINGS] for pose in MONSTER_POSES]
+            for name in game.flattened_monster_names
+        ]
+        game.monster_asset_keys_src = game.flattened_monster_names[:]
+    return game.monster_asset_keys
+
+
+# out is an optional canvas reused between calls (see new_frame_canvas), the returned image may share
+# its memory, so it must be consumed before drawing the next frame into the same canvas
 def draw_game_frame(
     game, frame_id, asset_map, kx, ky,
-    gen_original=False, single_channel_label=False
+    gen_original=False, single_channel_label=False, out=None
 ):
     # initialize an empty image (all zero, for background)
-    if (not gen_original) and single_channel_label:
-        img = Image.new('L', (game.video_res, game.video_res))
+    # semantic maps are drawn directly into a single channel numpy array of labels (see Asset.label)
+    # and only converted to an image at the end
+    if out is None:
+        img = new_frame_canvas(game, gen_original)
+    elif gen_original:
+        img = out
+        img.paste(0, (0, 0) + img.size)
     else:
-        img = Image.new('RGB', (game.video_res, game.video_res))
+        img = out
+        img.fill(0)
 
     video_center = (game.video_res - 1) // 2
 
@@ -487,14 +624,20 @@ def draw_game_frame(
     if gen_original:
         zx = game.video_res * game.zoom
         zy = zx
+        # the background is zoom times larger than the frame, so usually only 1 or 2 copies per axis are visible.
+        # columns and rows out of the frame are skipped before computing anything else for them
+        bg_asset = asset_map['background'].asset
+        bg_w, bg_h = math.ceil(zx), math.ceil(zy)
         for tile_x in range(-1, 3):
+            bg_x = zx * tile_x + video_center + game.bgzoom * (dx + kx * game.maze_h / 2) - zx * 0.5
+            if bg_x + zx < 0 or bg_x > game.video_res:
+                continue
             for tile_y in range(-1, 2):
-                bg_rect = [0, 0, zx, zy]
-                bg_rect[0] = zx * tile_x + video_center + game.bgzoom * (dx + kx * game.maze_h / 2) - zx * 0.5
-                bg_rect[1] = zy * tile_y + video_center + game.bgzoom * (dy - ky * game.maze_h / 2) - zy * 0.5
-                if check_out_of_bounds(bg_rect, img.size):
+                bg_y = zy * tile_y + video_center + game.bgzoom * (dy - ky * game.maze_h / 2) - zy * 0.5
+                if bg_y + zy < 0 or bg_y > game.video_res:
                     continue
-                img.paste(asset_map['background'].asset, convert_xywh_to_xyxy(integer_rect(bg_rect)))
+                bg_x0, bg_y0 = math.floor(bg_x), math.floor(bg_y)
+                img.paste(bg_asset, (bg_x0, bg_y0, bg_x0 + bg_w, bg_y0 + bg_h))
 
     # NOTE: game engine now hard-code 64 for maze_size
     radius = int(1 + game.maze_w / game.zoom)
@@ -506,144 +649,133 @@ def draw_game_frame(
     y_end = min(iy + radius + 1, game.maze_h)
     win_h = game.video_res
 
-    # convert eaten coins to a set for faster checking coordinates
-    coins_eaten_set = set([tuple(coin_coord) for coin_coord in frame.coins_eaten])
-
     ## paint the world with background, ground, crates, coins, etc.
-    for y in range(y_start, y_end):
-        for x in range(x_start, x_end):
-            wkey = game.maze[y][x]
-            if wkey == SPACE:
-                continue
+    # select the tiles to paint on the whole visible window at once, only those are looped over
+    maze_window = get_maze_array(game)[y_start:y_end, x_start:x_end]
+    tile_mask = maze_window != SPACE
+
+    # eaten coins is treated the same as SPACE, just skip them
+    # but we should not modify the coins in maze to SPACE, or it may cause inconsistency
+    # if we ever need to render backwards or save json after drawing
+    coins_eaten = np.asarray(frame.coins_eaten, dtype=np.int64).reshape(-1, 2)
+    coin_xs = coins_eaten[:, 0] - x_start
+    coin_ys = coins_eaten[:, 1] - y_start
+    coin_visible = (
+        (coin_xs >= 0) & (coin_xs < tile_mask.shape[1]) &
+        (coin_ys >= 0) & (coin_ys < tile_mask.shape[0])
+    )
+    tile_mask[coin_ys[coin_visible], coin_xs[coin_visible]] = False
+
+    tile_w = kx + .5 + 0.2
+    tile_h = ky + .5 + 0.2
+    tile_ys, tile_xs = np.nonzero(tile_mask)
+    tile_xs += x_start
+    tile_ys += y_start
+    tile_x0 = kx * tile_xs + dx - 0.1
+    tile_y0 = win_h - ky * tile_ys + dy - 0.1
+
+    # skip tiles whose rect is completely out-of-bounds
+    in_bounds = (
+        (tile_x0 + tile_w >= 0) & (tile_x0 <= game.video_res) &
+        (tile_y0 + tile_h >= 0) & (tile_y0 <= game.video_res)
+    )
 
-            # eaten coins is treated the same as SPACE, just continue
-            # but we should not modify the coins in maze to SPACE, or it may cause inconsistency
-            # if we ever need to render backwards or save json after drawing
-            if (x, y) in coins_eaten_set:
-                continue
+    # lava animation phase in [0, 1), the same for all lava tiles in a frame
+    lava_phase = frame.state_time * 0.1
+    lava_phase -= int(lava_phase)
 
-            assert wkey in asset_map, f'{wkey} not in assets!'
+    tile_keys = maze_window[tile_mask][in_bounds]
+    # integer paste rects for all tiles at once, floor of the top left corner and ceil of the size
+    tile_ix0 = np.floor(tile_x0[in_bounds]).astype(np.int64)
+    tile_iy0 = np.floor(tile_y0[in_bounds]).astype(np.int64)
+    tile_iw = math.ceil(tile_w)
+    tile_ih = math.ceil(tile_h)
 
-            tile_rect = [
-                kx * x + dx - 0.1,
-                win_h - ky * y + dy - 0.1,
-                kx + .5 + 0.2,
-                ky + .5 + 0.2]
+    for wkey, x0, y0, ix0, iy0 in zip(
+        tile_keys.tolist(), tile_x0[in_bounds].tolist(), tile_y0[in_bounds].tolist(),
+        tile_ix0.tolist(), tile_iy0.tolist()
+    ):
+        assert wkey in asset_map, f'{wkey} not in assets!'
+        tile_asset = asset_map[wkey]
 
-            # skip tile if the rect is completely out-of-bounds
-            if check_out_of_bounds(tile_rect, img.size):
-                continue
+        if wkey==LAVA_MIDDLE or wkey==LAVA_SURFACE:
+            # lava scrolls horizontally
+            paint_lava(img, [x0, y0, tile_w, tile_h], tile_asset, lava_phase, gen_original=gen_original)
+            continue
 
-            # NOTE: this is quite complex and might be slow
-            # in practice we may want to skip this and show some approximate mask?
-            if wkey==LAVA_MIDDLE or wkey==LAVA_SURFACE:
-                d1 = tile_rect[:]
-                d2 = tile_rect[:]
-                asset_size = asset_map[wkey].asset.size
-                sr = [0, 0, asset_size[0], asset_size[1]]
-                sr1 = sr[:]
-                sr2 = sr[:]
-                tr = frame.state_time * 0.1
-                tr -= int(tr)
-                tr *= -1
-                d1[0] += tr * tile_rect[2]
-                d2[0] += tile_rect[2] + tr * tile_rect[2]
-                sr1[0] += -tr * asset_size[0]
-                sr2[0] += -asset_size[0] - tr * asset_size[0]
-                d1 = intersect_rects(d1, tile_rect)
-                d2 = intersect_rects(d2, tile_rect)
-                if d1 is not None:
-                    d1[2] += 0.5
-                if d2 is not None:
-                    d2[0] -= 0.5
-                    d2[2] += 0.5
-                sr1 = intersect_rects(sr1, sr)
-                sr2 = intersect_rects(sr2, sr)
-                if sr1 is not None and d1 is not None:
-                    # crop and render one half of the asset
-                    # NOTE: not sure if this should be convert_xywh_to_xyxy(integer_rect(sr1))
-                    #       to be validated with more lava frames
-                    crop_mask = asset_map[wkey].asset.crop(integer_rect(convert_xywh_to_xyxy(sr1)))
-                    paint_color_in_rect_with_mask(
-                        img, integer_rect(d1), asset_map[wkey].semantic_color,
-                        crop_mask, gen_original=gen_original
-                    )
-                if sr2 is not None and d2 is not None:
-                    # crop and render the other half of the asset (swapped places horizontally)
-                    crop_mask = asset_map[wkey].asset.crop(integer_rect(convert_xywh_to_xyxy(sr2)))
-                    paint_color_in_rect_with_mask(
-                        img, integer_rect(d2), asset_map[wkey].semantic_color,
-                        crop_mask, gen_original=gen_original
-                    )
-            else:
-                paint_color_in_rect_with_mask(
-                    img, integer_rect(tile_rect), asset_map[wkey].semantic_color,
-                    asset_map[wkey].asset, gen_original=gen_original
-                )
+        if gen_original:
+            mask = tile_asset.asset
+        else:
+            mask = tile_asset.get_alpha_mask(tile_iw, tile_ih)
+
+        paint_color_in_rect_with_mask(
+            img, [ix0, iy0, tile_iw, tile_ih], tile_asset.label,
+            mask, gen_original=gen_original
+        )
 
     ## paint monsters
-    for mi in range(len(frame.monsters)):
-        if frame.monsters[mi].is_dead:
-            dying_frame_cnt = max(0, frame.monsters[mi].monster_dying_frame_cnt)
-            monster_shrinkage = (MONSTER_DEATH_ANIM_LENGTH - dying_frame_cnt) * 0.8 / MONSTER_DEATH_ANIM_LENGTH
-            monster_rect = [
-                math.floor(kx * frame.monsters[mi].x + dx),
-                math.floor(win_h - ky * frame.monsters[mi].y + dy + ky * monster_shrinkage),
-                math.ceil(kx),
-                math.ceil(ky * (1 - monster_shrinkage))
-            ]
-        else:
-            monster_rect = [
-                math.floor(kx * frame.monsters[mi].x + dx),
-                math.floor(win_h - ky * frame.monsters[mi].y + dy),
-                math.ceil(kx),
-                math.ceil(ky)
-            ]
-
-        m_name = game.flattened_monster_names[frame.monsters[mi].theme]
-        # add pose and facing to the key to find correct asset
-        # TODO: validate if walk1/walk2 might be mixed up
-        m_pose = '' if frame.monsters[mi].walk1_mode else '_move'
-        if frame.monsters[mi].is_dead:
-            m_pose = '_dead'
-        m_key = m_name + m_pose + ('_right' if frame.monsters[mi].vx > 0 else '')
+    # rects of all monsters at once, dying monsters shrink towards the ground
+    monsters = get_monster_arrays(game, frame)
+    dying_frame_cnt = np.maximum(0, monsters['dying_frame_cnt'])
+    monster_shrinkage = np.where(
+        monsters['is_dead'], (MONSTER_DEATH_ANIM_LENGTH - dying_frame_cnt) * 0.8 / MONSTER_DEATH_ANIM_LENGTH, 0.0
+    )
+    monster_x0 = np.floor(kx * monsters['x'] + dx).astype(np.int64)
+    monster_y0 = np.floor(win_h - ky * monsters['y'] + dy + ky * monster_shrinkage).astype(np.int64)
+    monster_w = math.ceil(kx)
+    monster_h = np.ceil(ky * (1 - monster_shrinkage)).astype(np.int64)
+
+    # pose and facing select the correct asset for each monster
+    # TODO: validate if walk1/walk2 might be mixed up
+    monster_pose = np.where(monsters['is_dead'], 2, np.where(monsters['walk1_mode'], 0, 1))
+    monster_facing = (monsters['vx'] > 0).astype(np.int64)
+    monster_asset_keys = get_monster_asset_keys(game)
+
+    for theme, pose, facing, x0, y0, h in zip(
+        monsters['theme'].tolist(), monster_pose.tolist(), monster_facing.tolist(),
+        monster_x0.tolist(), monster_y0.tolist(), monster_h.tolist(),
+    ):
+        monster_rect = [x0, y0, monster_w, h]
+        m_asset = asset_map[monster_asset_keys[theme][pose][facing]]
 
         paint_color_in_rect_with_mask(
-            img, monster_rect, asset_map[m_key].semantic_color,
-            asset_map[m_key].asset, gen_original=gen_original
+            img, monster_rect, m_asset.label,
+            m_asset.asset if gen_original else m_asset.get_alpha_mask(monster_rect[2], monster_rect[3]),
+            gen_original=gen_original
         )
 
     ## paint agent - do it after monsters so agent is always in front
     a_key = frame.agent.pose + ('' if frame.agent.is_facing_right else '_left')
+    a_asset = asset_map[a_key]
     # note how aspect_ratio is used for alien rect, this can be applied to
     # monster rect to support asset that's not 1:1 (e.g. use alien as monster)
     # NOTE: current implementation always use the same rendering width and just height based on aspect ratio
     alien_rect = [
         math.floor(kx * frame.agent.x + dx),
         # math.floor(win_h - ky * (frame.agent.y + 1) + dy),    # default for 2:1 alien, no asset swap
-        math.floor(win_h - ky * (frame.agent.y + asset_map[a_key].aspect_ratio - 1) + dy),
+        math.floor(win_h - ky * (frame.agent.y + a_asset.aspect_ratio - 1) + dy),
         math.ceil(kx),
         # math.ceil(2 * ky),    # default for 2:1 alien, no asset swap
-        math.ceil(asset_map[a_key].aspect_ratio * ky),
+        math.ceil(a_asset.aspect_ratio * ky),
     ]
+    if gen_original:
+        agent_asset = a_asset.asset
+    else:
+        agent_asset = a_asset.get_alpha_mask(alien_rect[2], alien_rect[3])
+    draw_agent = True
     if frame.agent.is_killed:
         transparency = (DEATH_ANIM_LENGTH + 1 - frame.agent.killed_animation_frame_cnt)*12
         # only render if not fully transparent
         if transparency > 255:
-            agent_asset = None
-        else:
-            if gen_original:
-                # NOTE: now only changing alpha but not saturation like in the game engine
-                # (HSV doesn't work for some reason), but the effect is pretty similar
-                agent_asset = get_transparent_asset(asset_map[a_key].asset, transparency)
-            else:
-                # when generating semantic map, alien mask won't change unless fully transparent
-                agent_asset = asset_map[a_key].asset
-    else:
-        agent_asset = asset_map[a_key].asset
-    if agent_asset is not None:
+            draw_agent = False
+        elif gen_original:
+            # NOTE: now only changing alpha but not saturation like in the game engine
+            # (HSV doesn't work for some reason), but the effect is pretty similar
+            agent_asset = get_cached_transparent_asset(a_asset, transparency)
+        # when generating semantic map, alien mask won't change unless fully transparent
+    if draw_agent:
         paint_color_in_rect_with_mask(
-            img, alien_rect, asset_map[a_key].semantic_color,
+            img, alien_rect, a_asset.label,
             agent_asset, gen_original=gen_original
         )
 
@@ -662,28 +794,98 @@ def draw_game_frame(
         if frame.agent.pose == 'duck':
             shield_rect[1] += math.floor(8 * game.video_res / 1024)
 
+        shield_asset = asset_map['shield']
         paint_color_in_rect_with_mask(
-            img, shield_rect, asset_map['shield'].semantic_color,
-            asset_map['shield'].asset, gen_original=gen_original
+            img, shield_rect, shield_asset.label,
+            shield_asset.asset if gen_original else shield_asset.get_alpha_mask(shield_rect[2], shield_rect[3]),
+            gen_original=gen_original
         )
 
+    if not gen_original:
+        if single_channel_label:
+            img = Image.fromarray(img)
+        else:
+            img = Image.fromarray(img, 'P')
+            img.putpalette(get_semantic_palette_bytes())
+            img = img.convert('RGB')
     return img
 
 
+# if save_executor is given, png encoding and writing is submitted to it and the future is returned
 def draw_and_save_single_frame(
     game, frame_id, level_id, asset_map, output_folder, kx, ky,
-    gen_original=False, single_channel_label=False
+    gen_original=False, single_channel_label=False, save_executor=None, out=None
 ):
+    assert save_executor is None or out is None, "can't reuse the canvas while saving in the background"
     img = draw_game_frame(
         game, frame_id, asset_map, kx, ky,
-        gen_original=gen_original, single_channel_label=single_channel_label
+        gen_original=gen_original, single_channel_label=single_channel_label, out=out
     )
     output_path = os.path.join(
         output_folder,
         "level_{:04d}_frame_{:04d}.png".format(level_id, frame_id)
     )
+    if save_executor is not None:
+        return save_executor.submit(img.save, output_path)
     img.save(output_path)
-    return 
+    return
+
+
+# pick the first hardware h264 encoder that works with the ffmpeg used by imageio, otherwise libx264.
+# ffmpeg builds often list hardware encoders without a usable device (e.g. h264_nvenc without a gpu),
+# so each listed one is tried on a single tiny frame
+@functools.lru_cache(maxsize=None)
+def detect_video_codec():
+    try:
+        import imageio_ffmpeg
+        ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        ffmpeg_exe = 'ffmpeg'
+    try:
+        encoders = subprocess.run(
+            [ffmpeg_exe, '-hide_banner', '-encoders'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True,
+        ).stdout
+    except OSError:
+        return 'libx264'
+    available = {line.split()[1] for line in encoders.splitlines() if len(line.split()) > 1}
+    for codec in HW_VIDEO_CODECS:
+        if codec in available and can_encode_with(ffmpeg_exe, codec):
+            return codec
+    return 'libx264'
+
+
+def can_encode_with(ffmpeg_exe, codec):
+    try:
+        return subprocess.run(
+            [ffmpeg_exe, '-hide_banner', '-loglevel', 'error', '-nostdin',
+             '-f', 'lavfi', '-i', 'nullsrc=s=256x256', '-frames:v', '1',
+             '-c:v', codec, '-pix_fmt', 'yuv420p', '-f', 'null', '-'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30,
+        ).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+# append frames from frame_queue to the video writer until None is received, then close it
+# run on a background thread so that rendering and video encoding overlap,
+# an encoding error is put in errors and the queue is still drained so the producer never blocks on it.
+# closing flushes the encoder and can fail as well, that error is reported the same way
+def write_video_frames(writer, frame_queue, errors):
+    try:
+        while True:
+            frame = frame_queue.get()
+            if frame is None:
+                break
+            writer.append_data(frame)
+    except Exception as e:
+        errors.append(e)
+        while frame_queue.get() is not None:
+            pass
+    try:
+        writer.close()
+    except Exception as e:
+        errors.append(e)
 
 
 def parse_args():
@@ -710,6 +912,10 @@ def parse_args():
         "--level_id", type=int, default=0,
         help="level id to load json metadata"
     )
+    parser.add_argument(
+        "--num_workers", type=int, default=1,
+        help="number of processes used to render frames in parallel, only effective when frame_id < 0",
+    )
     parser.add_argument(
         "--output_folder", type=str,
         default="constructed_data",
@@ -723,6 +929,10 @@ def parse_args():
         "--save_as_video", action="store_true", default=False,
         help="save result as video instead of pngs, only effective when frame_id < 0",
     )
+    parser.add_argument(
+        "--video_codec", type=str, default="libx264",
+        help="ffmpeg codec used with save_as_video, 'auto' to use a hardware h264 encoder when available",
+    )
     parser.add_argument(
         "--single_channel_label", action="store_true", default=False,
         help="use single channel label for semantic maps, instead of three channels",
@@ -738,6 +948,9 @@ def parse_args():
         args.input_json = os.path.join(
             "video_data", args.restore_id, args.json_folder, "level_{:04d}.json".format(args.level_id)
         )
+        # levels converted with --compress are saved as .json.gz
+        if not os.path.isfile(args.input_json) and os.path.isfile(args.input_json + ".gz"):
+            args.input_json += ".gz"
 
     args.output_folder = os.path.join("video_data", args.restore_id, args.output_folder)
 
@@ -748,9 +961,7 @@ def parse_args():
     return args
 
 
-if __name__ == "__main__":
-    args = parse_args()
-
+def load_game_and_assets(args):
     game = Game()
     game.load_json(args.input_json)
 
@@ -770,6 +981,47 @@ if __name__ == "__main__":
     zy = zx
     asset_map['background'] = load_bg_asset(asset_files, semantic_color_map, zx, zy)
 
+    return game, asset_map, kx, ky
+
+
+# game and assets of a rendering worker process, loaded once by init_render_worker
+render_worker_context = None
+
+
+def init_render_worker(args):
+    global render_worker_context
+    game, asset_map, kx, ky = load_game_and_assets(args)
+    # each worker draws all its frames into the same canvas, frames are consumed before the next one
+    canvas = new_frame_canvas(game, args.gen_original)
+    render_worker_context = (args, game, asset_map, kx, ky, canvas)
+
+
+# render one frame in a worker process, return it for video or save it as png
+def render_frame_in_worker(frame_id):
+    args, game, asset_map, kx, ky, canvas = render_worker_context
+    if args.save_as_video:
+        return np.asarray(draw_game_frame(
+            game, frame_id, asset_map, kx, ky,
+            gen_original=args.gen_original, single_channel_label=args.single_channel_label, out=canvas
+        ))
+    draw_and_save_single_frame(
+        game, frame_id, args.level_id, asset_map, args.output_folder, kx, ky,
+        gen_original=args.gen_original, single_channel_label=args.single_channel_label, out=canvas
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    game, asset_map, kx, ky = load_game_and_assets(args)
+
+    # frames are independent, so with multiple workers they are rendered in a process pool
+    # where each worker loads the game and assets once
+    render_pool = None
+    if args.frame_id < 0 and args.num_workers > 1:
+        render_pool = multiprocessing.Pool(args.num_workers, initializer=init_render_worker, initargs=(args,))
+    frame_ids = range(len(game.frames))
+
     if args.frame_id >= 0:
         # draw a specific frame
         assert args.frame_id < len(game.frames)
@@ -779,21 +1031,59 @@ if __name__ == "__main__":
         )
     else:
         if not args.save_as_video:
-            # draw all frames in this level
-            for fi in tqdm(range(len(game.frames))):
-                draw_and_save_single_frame(
-                    game, fi, args.level_id, asset_map, args.output_folder, kx, ky,
-                    gen_original=args.gen_original, single_channel_label=args.single_channel_label
-                )
+            if render_pool is not None:
+                for _ in tqdm(render_pool.imap_unordered(render_frame_in_worker, frame_ids, chunksize=8), total=len(frame_ids)):
+                    pass
+            else:
+                # draw all frames in this level, pngs are encoded and written in background threads
+                with ThreadPoolExecutor(max_workers=4) as save_executor:
+                    save_futures = [
+                        draw_and_save_single_frame(
+                            game, fi, args.level_id, asset_map, args.output_folder, kx, ky,
+                            gen_original=args.gen_original, single_channel_label=args.single_channel_label,
+                            save_executor=save_executor,
+                        )
+                        for fi in tqdm(frame_ids)
+                    ]
+                # re-raise any error from saving
+                for future in save_futures:
+                    future.result()
         else:
             # save as video instead of pngs, use same filename as json
-            video_fn = os.path.splitext(os.path.basename(args.input_json))[0] + '_constructed.mp4'
+            video_fn = os.path.basename(args.input_json).split('.json')[0] + '_constructed.mp4'
             video_path = os.path.join(args.output_folder, video_fn)
-            writer = imageio.get_writer(video_path, fps=30)
-            for fi in tqdm(range(len(game.frames))):
-                frame = draw_game_frame(
-                    game, fi, asset_map, kx, ky,
-                    gen_original=args.gen_original, single_channel_label=args.single_channel_label
+            video_codec = detect_video_codec() if args.video_codec == 'auto' else args.video_codec
+            writer = imageio.get_writer(video_path, fps=30, codec=video_codec)
+            # bounded, so rendering waits for the encoder instead of piling up frames in memory
+            frame_queue = queue.Queue(maxsize=8)
+            video_errors = []
+            writer_thread = threading.Thread(
+                target=write_video_frames, args=(writer, frame_queue, video_errors), daemon=True
+            )
+            writer_thread.start()
+            if render_pool is not None:
+                # imap keeps the frames in order
+                frames = render_pool.imap(render_frame_in_worker, frame_ids, chunksize=8)
+            else:
+                frames = (
+                    np.asarray(draw_game_frame(
+                        game, fi, asset_map, kx, ky,
+                        gen_original=args.gen_original, single_channel_label=args.single_channel_label
+                    ))
+                    for fi in frame_ids
                 )
-                writer.append_data(np.array(frame))
-            writer.close()
+            try:
+                for frame in tqdm(frames, total=len(frame_ids)):
+                    if video_errors:
+                        break
+                    frame_queue.put(frame)
+            finally:
+                # always stop the writer thread, so the video is closed even if rendering fails
+                frame_queue.put(None)
+                writer_thread.join()
+            if video_errors:
+                raise video_errors[0]
+
+    if render_pool is not None:
+        render_pool.close()
+        render_pool.join()
@@ -7,15 +7,35 @@ Usage:
 """
 
 import argparse
+import csv
+import gzip
 import json
+import multiprocessing
 import numpy as np
 import os
 
+# orjson is optional, it's only used to read and write json metadata faster when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# json metadata is gzip compressed when its path ends with .gz
+def open_json_file(json_path, mode):
+    if json_path.endswith('.gz'):
+        return gzip.open(json_path, mode if 'b' in mode else mode + 't', compresslevel=3)
+    return open(json_path, mode)
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Convert monitor.csv file to json files"
     )
+    parser.add_argument(
+        "--compress", action="store_true", default=False,
+        help="Save gzip compressed level_XXXX.json.gz files"
+    )
     parser.add_argument(
         "--data_root", type=str, default="video_data",
         help="Root folder for both input and output sub-folders"
@@ -24,6 +44,10 @@ def parse_args():
         "--input", type=str, default=None,
         help="Specify a path to monitor.csv file if it's not the default path with restore_id"
     )
+    parser.add_argument(
+        "--num_workers", type=int, default=1,
+        help="number of processes used to convert levels in parallel"
+    )
     parser.add_argument(
         "--output_folder", type=str, default="json_metadata",
         help="Output folder for generated json files"
@@ -78,12 +102,16 @@ class Game:
         self.maze = None
         self.frames = []
     
-    def asdict(self, f_start=-1, f_end=-1):
-        if f_end < 0:
-            # show all frames by default
-            frames_as_dict = [f.asdict() for f in self.frames]
-        else:
-            frames_as_dict = [f.asdict() for f in self.frames[f_start:f_end]]
+    # dicts of the frames in [f_start, f_end), all frames by default. frames loaded from json that were
+    # never accessed are still the dicts read from the file, so they are written back as is
+    def frame_dicts(self, f_start=-1, f_end=-1):
+        frames = self.frames.items if isinstance(self.frames, LazyFrameList) else self.frames
+        if f_end >= 0:
+            frames = frames[f_start:f_end]
+        return (f.asdict() if isinstance(f, Frame) else f for f in frames)
+
+    # everything except the frames
+    def header_asdict(self):
         return {
             "game_id": self.game_id,
             "level_seed": self.level_seed,
@@ -100,48 +128,129 @@ class Game:
             "maze_w": self.maze_w,
             "maze_h": self.maze_h,
             "maze": self.maze if self.maze is not None else None,
-            "frames": frames_as_dict,
         }
+
+    def asdict(self, f_start=-1, f_end=-1):
+        game_dict = self.header_asdict()
+        game_dict["frames"] = list(self.frame_dicts(f_start, f_end))
+        return game_dict
     
     def __repr__(self):
         return json.dumps(self.asdict())
     
-    def save_json(self, json_path, f_start=-1, f_end=-1):
-        with open(json_path, "w") as f:
-            json.dump(self.asdict(f_start, f_end), f, indent=2)
+    # frames are written one at a time instead of building the dict of the whole game first,
+    # pass indent (e.g. 2) to get a human readable file through the slower non-streaming path,
+    # a json_path ending with .gz is written gzip compressed
+    def save_json(self, json_path, f_start=-1, f_end=-1, indent=None):
+        if indent is not None:
+            with open_json_file(json_path, "w") as f:
+                json.dump(self.asdict(f_start, f_end), f, indent=indent)
+        elif orjson is not None:
+            with open_json_file(json_path, "wb") as f:
+                f.write(orjson.dumps(self.header_asdict())[:-1] + b',"frames":[')
+                for i, frame_dict in enumerate(self.frame_dicts(f_start, f_end)):
+                    if i:
+                        f.write(b',')
+                    f.write(orjson.dumps(frame_dict))
+                f.write(b']}')
+        else:
+            with open_json_file(json_path, "w") as f:
+                header = json.dumps(self.header_asdict())
+                f.write(header[:-1] + ', "frames": [')
+                for i, frame_dict in enumerate(self.frame_dicts(f_start, f_end)):
+                    if i:
+                        f.write(', ')
+                    json.dump(frame_dict, f)
+                f.write(']}')
     
     def load_json(self, json_path):
-        with open(json_path, "r") as f:
-            data = json.load(f)
+        if orjson is not None:
+            with open_json_file(json_path, "rb") as f:
+                data = orjson.loads(f.read())
+        else:
+            with open_json_file(json_path, "r") as f:
+                data = json.load(f)
         
         self.reset_game()
-        self.__dict__.update(**data)
-        self.frames = [Frame(**f) for f in self.frames]
-        # self.frames = {f[0]: Frame(**f[1]) for f in self.frames.items()}
+        # only take the known fields, unknown keys in the json file are ignored
+        for key in self.header_asdict():
+            if key in data:
+                setattr(self, key, data[key])
+        self.frames = LazyFrameList(data.get("frames", []))
 
         self.flatten_monster_names()
     
     def flatten_monster_names(self):
+        # this extends monster_names['ground'] in place, so only do it once for the loaded names
+        # (asset path generation calls it again for every world theme)
+        if self.flattened_monster_names is self.monster_names.get('ground'):
+            return
         # the order is important!
         self.flattened_monster_names = self.monster_names['ground']
         self.flattened_monster_names.extend(self.monster_names['walking'])
         self.flattened_monster_names.extend(self.monster_names['flying'])
 
 
+# list-like container of frames loaded from json, each Frame is only built from its dict
+# the first time it's accessed, so rendering a single frame doesn't construct the whole game
+class LazyFrameList:
+    def __init__(self, frame_dicts):
+        self.items = frame_dicts
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.items)))]
+        item = self.items[index]
+        if not isinstance(item, Frame):
+            item = Frame(**item)
+            self.items[index] = item
+        return item
+
+    def __iter__(self):
+        for i in range(len(self.items)):
+            yield self[i]
+
+    def append(self, frame):
+        self.items.append(frame)
+
+
+# Frame/Agent/Monster stay small __slots__ objects rather than proxies into game-wide numpy arrays:
+# the renderer reads their attributes directly and builds per-frame monster columns itself
+# (get_monster_arrays in construct_data_from_json.py), and LazyFrameList only builds the frames used
 class Frame:
-    def __init__(self, **kwargs):
-        self.frame_id = -1
-        self.file_name = ""
-        self.state_time = 0
-        self.coins_eaten = []
-        self.agent = None
-        self.monsters = []
+    __slots__ = (
+        'frame_id', 'file_name', 'state_time', 'coins_eaten_ref', 'coins_eaten_len', 'agent', 'monsters',
+    )
 
-        self.__dict__.update(**kwargs)
-        if 'agent' in self.__dict__ and self.agent is not None:
-            self.agent = Agent(**self.agent)
-        if 'monsters' in self.__dict__:
-            self.monsters = [Monster(**m) for m in self.monsters]
+    def __init__(
+        self, frame_id=-1, file_name="", state_time=0, coins_eaten=None,
+        agent=None, monsters=None, **kwargs
+    ):
+        self.frame_id = frame_id
+        self.file_name = file_name
+        self.state_time = state_time
+        self.coins_eaten = coins_eaten if coins_eaten is not None else []
+        self.agent = Agent(**agent) if agent is not None else None
+        self.monsters = [Monster(**m) for m in monsters] if monsters is not None else []
+
+        # kwargs are ignored
+
+    # coins are only appended during a game, so frames of the same game can share one list
+    # and only remember how many coins had been eaten by then, instead of each keeping a copy
+    @property
+    def coins_eaten(self):
+        return self.coins_eaten_ref[:self.coins_eaten_len]
+
+    @coins_eaten.setter
+    def coins_eaten(self, coins_eaten):
+        self.share_coins_eaten(coins_eaten, len(coins_eaten))
+
+    def share_coins_eaten(self, coins_eaten, count):
+        self.coins_eaten_ref = coins_eaten
+        self.coins_eaten_len = count
         
     def asdict(self):
         return {
@@ -158,6 +267,13 @@ class Frame:
 
         
 class Agent:
+    __slots__ = (
+        'x', 'y', 'vx', 'vy', 'time_alive', 'ladder', 'spring', 'is_killed',
+        'killed_animation_frame_cnt', 'finished_level_frame_cnt', 'killed_monster',
+        'bumped_head', 'collected_coin', 'collected_gem', 'power_up_mode',
+        'anim_freq', 'is_facing_right', 'walk1_mode', 'pose',
+    )
+
     def __init__(
         self, x, y, vx=0.0, vy=0.0, time_alive=0,
         ladder=False, spring=0, is_killed=False,
@@ -168,6 +284,7 @@ class Agent:
         collected_coin=False,
         collected_gem=False,
         power_up_mode=False,
+        known_pose=None,
         **kwargs
     ):
         self.x = x
@@ -200,11 +317,14 @@ class Agent:
         if (self.time_alive // self.anim_freq) % 2 != 0:
             self.walk1_mode = False
             
-        self.pose = self.get_pose()
+        # known_pose is only given when it was just computed from the same state, by get_agent_poses.
+        # a pose stored in json lands in kwargs and is recomputed, so a stale value is never kept
+        self.pose = known_pose if known_pose is not None else self.get_pose()
 
         # kwargs are ignored
-        # self.__dict__.update(**kwargs)
 
+    # poses are returned as string literals, which the compiler interns, so all agents already share
+    # the same few string objects (the pose loaded from json is recomputed here, not kept)
     def get_pose(self):
         if self.is_killed:
             return "hit"
@@ -224,6 +344,8 @@ class Agent:
         else:
             return "walk2"
     
+    # dict displays with constant keys (here and in Frame/Monster) are built in a single step by
+    # the interpreter, measured ~2x faster than dict(zip(keys, values)) so they're kept as is
     def asdict(self):
         return {
             "x": self.x,
@@ -252,6 +374,11 @@ class Agent:
 
 
 class Monster:
+    __slots__ = (
+        'm_id', 'x', 'y', 'vx', 'vy', 'theme', 'is_flying', 'is_walking', 'is_jumping',
+        'is_dead', 'time', 'anim_freq', 'monster_dying_frame_cnt', 'walk1_mode',
+    )
+
     def __init__(
         self, m_id, x, y, vx=0.0, vy=0.0, theme=0,
         is_flying=False, is_walking=False, is_jumping=False, is_dead=False,
@@ -281,7 +408,6 @@ class Monster:
             self.walk1_mode = False
 
         # kwargs are ignored
-        # self.__dict__.update(**kwargs)
         
     def asdict(self):
         return {
@@ -305,136 +431,216 @@ class Monster:
         return json.dumps(self.asdict())
 
 
-def convert_csv_to_json(input_file, output_folder):
-    with open(input_file, 'r') as f:
-        lines = f.readlines()
+# drop the empty field left by the trailing comma the game engine writes
+def strip_row(row):
+    if row and row[-1] == '':
+        row.pop()
+    return row
+
+
+def next_row(reader):
+    return strip_row(next(reader))
+
+
+# convert rows of number strings all at once, return one flat float64 array and each row's length
+def parse_number_rows(rows):
+    row_lengths = [len(row) for row in rows]
+    return np.array([v for row in rows for v in row], dtype=np.float64), row_lengths
+
+
+AGENT_POSES = ['hit', 'climb1', 'climb2', 'jump', 'duck', 'stand', 'walk1', 'walk2']
+
+
+# same rules as Agent.get_pose, applied to the (n, 16) agent rows of all frames at once
+def get_agent_poses(agent_array):
+    walk2 = ((agent_array[:, 0] // 5) % 2 != 0).astype(np.int64)   # agent anim_freq is hard-coded to 5
+    pose_ids = np.select(
+        [agent_array[:, 8] != 0, agent_array[:, 6] != 0, agent_array[:, 4] != 0,
+         agent_array[:, 7] != 0, agent_array[:, 3] == 0],
+        [0, 1 + walk2, 3, 4, 5],
+        default=6 + walk2,
+    )
+    return [AGENT_POSES[i] for i in pose_ids.tolist()]
+
+
+# build frames of the current game from its (coins eaten count, agent row, monsters row) tuples,
+# all agent and monster rows of the game are converted to numbers in bulk
+def add_frames(game, frame_rows, coins_eaten):
+    agent_array, agent_lengths = parse_number_rows([r[1] for r in frame_rows])
+    # agent information has 16 values per frame, should match how number is saved in game engine
+    assert all(n == 16 for n in agent_lengths)
+    agent_array = agent_array.reshape(-1, 16)
+    agent_poses = get_agent_poses(agent_array)
+    agent_values = agent_array.tolist()
+    monster_values, monster_lengths = parse_number_rows([r[2] for r in frame_rows])
+    monster_values = monster_values.tolist()
+    # state_time,monsters_count then 12 values for each monster, should match how number is saved in game engine
+    assert all((n - 2) % 12 == 0 for n in monster_lengths)
+    monster_offset = 0    # start of the current frame's monster information in monster_values
+    file_name_prefix = "level_{:04d}_frame_".format(game.game_id)   # shared by all frames of the game
+
+    for frame_id, (coins_count, _, _) in enumerate(frame_rows):
+        frame = Frame()
+        
+        # agent information
+        # time_alive,agent_x,agent_y,agent_vx,agent_vy,agent_facing_right,agent_ladder,agent_spring,is_killed,killed_animation_frame_cnt,finished_level_frame_cnt,killed_monster,bumped_head,collected_coin,collected_gem,power_up_mode
+        data = agent_values[frame_id]
+        frame.frame_id = frame_id
+        frame.file_name = f"{file_name_prefix}{frame_id:04d}.png"  # new format with level id
+        # frame.file_name = "frame_{:04d}.png".format(frame.frame_id)  # old format
+        frame.share_coins_eaten(coins_eaten, coins_count)
+
+        # load other agent info, ignoring agent_facing_right for now (can be inferred from vx)
+        frame.agent = Agent(x=data[1], y=data[2],
+                            vx=data[3], vy=data[4],
+                            time_alive=int(data[0]),
+                            ladder=bool(data[6]),
+                            spring=data[7],
+                            is_killed=bool(data[8]),
+                            killed_animation_frame_cnt=int(data[9]),
+                            finished_level_frame_cnt=int(data[10]),
+                            killed_monster=bool(data[11]),
+                            bumped_head=bool(data[12]),
+                            collected_coin=bool(data[13]),
+                            collected_gem=bool(data[14]),
+                            power_up_mode=bool(data[15]),
+                            known_pose=agent_poses[frame_id],
+                            )
+        
+        # monsters information
+        # state_time,monsters_count,(m_id,m_x,m_y,m_vx,m_vy,m_theme,m_flying,m_walking,m_jumping,m_dead,m_anim_freq,monster_dying_frame_cnt) <- repeat
+        data = monster_values[monster_offset:monster_offset + monster_lengths[frame_id]]
+        monster_offset += monster_lengths[frame_id]
+        
+        # NOTE: state->time may not always match agent->time_alive near game ends
+        state_time = int(data[0])
+        frame.state_time = state_time
+        
+        monster_count = int(data[1])
+        for mi in range(monster_count):
+            si = 2 + mi * 12   # start index of the current monster data
+            monster = Monster(m_id=int(data[si]),
+                              x=data[si+1], y=data[si+2],
+                              vx=data[si+3], vy=data[si+4],
+                              theme=int(data[si+5]),
+                              is_flying=bool(data[si+6]),
+                              is_walking=bool(data[si+7]),
+                              is_jumping=bool(data[si+8]),
+                              is_dead=bool(data[si+9]),
+                              time=state_time,
+                              anim_freq=int(data[si+10]),
+                              monster_dying_frame_cnt=int(data[si+11])
+                              )
+            frame.monsters.append(monster)
+        
+        game.frames.append(frame)
+
+
+# build the frames of one game from its raw rows and write its json file,
+# this is the expensive part of the conversion and runs in worker processes when num_workers > 1
+def save_game(game_fields, frame_rows, coins_eaten, game_json):
+    game = Game(**game_fields)
+    add_frames(game, frame_rows, coins_eaten)
+    game.save_json(game_json)
+
+
+# save the game right away, or queue it on the pool keeping at most a few games in flight
+# so the raw rows of the whole csv don't pile up in memory when workers are slower than reading
+def submit_game(pool, pending, num_workers, game, frame_rows, coins_eaten, json_format):
+    game_json = json_format.format(game.game_id)
+    args = (game.header_asdict(), frame_rows, coins_eaten, game_json)
+    if pool is None:
+        save_game(*args)
+        return
+    pending.append(pool.apply_async(save_game, args))
+    while len(pending) > 2 * num_workers:
+        pending.pop(0).get()
+
+
+def convert_csv_to_json(input_file, output_folder, num_workers=1, compress=False):
+    json_format = os.path.join(output_folder, "level_{:04d}.json" + (".gz" if compress else ""))
 
     # initialize empty game
     game = Game()
     game_id = -1
     total_frames = 0
     coins_eaten = []   # keep track of which coins were eaten in this game
-
-    for i, l in enumerate(lines):
-        if l.startswith('game_id'):
-            # game restart, load zoom, seeds, themes, and maze
-            if game_id >= 0:
-                game_json = os.path.join(output_folder, "level_{:04d}.json".format(game_id))
-                game.save_json(game_json)
-                game.reset_game()
+    frame_rows = []    # raw csv rows of the frames in this game, converted to frames when the game ends
+
+    # levels are independent once their rows are read, so they can be converted in parallel
+    pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+    pending = []
+
+    # the csv is read lazily row by row, header rows pull the data rows following them
+    with open(input_file, 'r', newline='') as f:
+        reader = csv.reader(f)
+        for row in reader:
+            row = strip_row(row)
+            if not row:
+                continue
+            if row[0] == 'game_id':
+                # game restart, load zoom, seeds, themes, and maze
+                if game_id >= 0:
+                    submit_game(pool, pending, num_workers, game, frame_rows, coins_eaten, json_format)
+                    game.reset_game()
+                    
+                # increment game_id, reset frames and coin status
+                game_id += 1
+                frame_rows = []
+                coins_eaten = []
                 
-            # increment game_id, reset frame_id and coin status
-            game_id += 1
-            frame_id = 0
-            coins_eaten = []
-            
-            # general game information in 2nd line
-            # game_id,maze_seed,zoom,world_theme_n,agent_theme_n
-            data = lines[i + 1].strip().strip(',').split(',')
-            assert len(data) == 5   # NOTE: should match how number is saved in game engine
-            assert game_id == int(data[0])
-            game.game_id = game_id
-            game.level_seed = int(data[1])
-            game.zoom = float(data[2])   # NOTE: zoom can be float number
-            game.world_theme_n = int(data[3])
-            game.agent_theme_n = int(data[4])
-            
-            # maze information in 3rd line
-            data = lines[i + 2].strip().strip(',').split(',')
-            # NOTE: be careful when maze size is not square
-            assert len(data) == game.maze_h * game.maze_w
-            # save maze as list of strings, each string is one row
-            maze_array = np.array(data).reshape((game.maze_h, -1)).tolist()
-            game.maze = [''.join(row) for row in maze_array]
-
-        elif l.startswith('time_alive'):
-            # agent & monster information line +1 and +3
-            frame = Frame()
-            
-            # agent information in 2nd line
-            # time_alive,agent_x,agent_y,agent_vx,agent_vy,agent_facing_right,agent_ladder,agent_spring,is_killed,killed_animation_frame_cnt,finished_level_frame_cnt,killed_monster,bumped_head,collected_coin,collected_gem,power_up_mode
-            data = lines[i + 1].strip().strip(',').split(',')
-            assert len(data) == 16   # should match how number is saved in game engine
-            frame.frame_id = frame_id
-            frame.file_name = "level_{:04d}_frame_{:04d}.png".format(game_id, frame_id)  # new format with level id
-            # frame.file_name = "frame_{:04d}.png".format(frame.frame_id)  # old format
-            frame.coins_eaten = coins_eaten[:]   # need to assign by value not reference!
-
-            # load other agent info, ignoring agent_facing_right for now (can be inferred from vx)
-            frame.agent = Agent(x=float(data[1]), y=float(data[2]),
-                                vx=float(data[3]), vy=float(data[4]),
-                                time_alive=int(data[0]),
-                                ladder=bool(int(data[6])),
-                                spring=float(data[7]),
-                                is_killed=bool(int(data[8])),
-                                killed_animation_frame_cnt=int(data[9]),
-                                finished_level_frame_cnt=int(data[10]),
-                                killed_monster=bool(int(data[11])),
-                                bumped_head=bool(int(data[12])),
-                                collected_coin=bool(int(data[13])),
-                                collected_gem=bool(int(data[14])),
-                                power_up_mode=bool(int(data[15])),
-                                )
-            
-            # monsters information in 4nd line
-            # state_time,monsters_count,(m_id,m_x,m_y,m_vx,m_vy,m_theme,m_flying,m_walking,m_jumping,m_dead,m_anim_freq,monster_dying_frame_cnt) <- repeat
-            data = lines[i + 3].strip().strip(',').split(',')
-            assert (len(data) - 2) % 12 == 0   # should match how number is saved in game engine
-            
-            # NOTE: state->time may not always match agent->time_alive near game ends
-            state_time = int(data[0])
-            frame.state_time = state_time
-            
-            monster_count = int(data[1])
-            for mi in range(monster_count):
-                si = 2 + mi * 12   # start index of the current monster data
-                monster = Monster(m_id=int(data[si]),
-                                  x=float(data[si+1]), y=float(data[si+2]),
-                                  vx=float(data[si+3]), vy=float(data[si+4]),
-                                  theme=int(data[si+5]),
-                                  is_flying=bool(int(data[si+6])),
-                                  is_walking=bool(int(data[si+7])),
-                                  is_jumping=bool(int(data[si+8])),
-                                  is_dead=bool(int(data[si+9])),
-                                  time=state_time,
-                                  anim_freq=int(data[si+10]),
-                                  monster_dying_frame_cnt=int(data[si+11])
-                                  )
-                frame.monsters.append(monster)
-            
-            game.frames.append(frame)
-            frame_id += 1
-            total_frames += 1
-
-        elif l.startswith('background_themes'):
-            # load theme file names, should only trigger for the first game level (won't reset)
-            data = l.strip().strip(',').split(',')
-            game.background_themes = data[1:]
-            data = lines[i + 1].strip().strip(',').split(',')
-            game.ground_themes = data[1:]
-            data = lines[i + 2].strip().strip(',').split(',')
-            game.agent_themes = data[1:]
-            data = lines[i + 3].strip().strip(',').split(',')
-            game.monster_names['ground'] = data[1:]
-            data = lines[i + 4].strip().strip(',').split(',')
-            game.monster_names['flying'] = data[1:]
-            data = lines[i + 5].strip().strip(',').split(',')
-            game.monster_names['walking'] = data[1:]
-
-        elif l.startswith('eat_coin'):
-            # update coins eaten in this game session so far
-            data = l.strip().strip(',').split(',')
-            assert len(data) == 3   # should only have 'eat_coin' then x and y
-            coins_eaten.append((int(data[1]), int(data[2])))
-
-        else:
-            continue
+                # general game information in 2nd line
+                # game_id,maze_seed,zoom,world_theme_n,agent_theme_n
+                data = next_row(reader)
+                assert len(data) == 5   # NOTE: should match how number is saved in game engine
+                assert game_id == int(data[0])
+                game.game_id = game_id
+                game.level_seed = int(data[1])
+                game.zoom = float(data[2])   # NOTE: zoom can be float number
+                game.world_theme_n = int(data[3])
+                game.agent_theme_n = int(data[4])
+                
+                # maze information in 3rd line
+                data = next_row(reader)
+                # NOTE: be careful when maze size is not square
+                assert len(data) == game.maze_h * game.maze_w
+                # save maze as list of strings, each string is one row
+                maze_str = ''.join(data)
+                game.maze = [maze_str[r * game.maze_w:(r + 1) * game.maze_w] for r in range(game.maze_h)]
+
+            elif row[0] == 'time_alive':
+                # agent information in 2nd line, monsters information in 4th line
+                agent_row = next_row(reader)
+                next(reader)
+                monster_row = next_row(reader)
+                frame_rows.append((len(coins_eaten), agent_row, monster_row))
+                total_frames += 1
+
+            elif row[0] == 'background_themes':
+                # load theme file names, should only trigger for the first game level (won't reset)
+                game.background_themes = row[1:]
+                game.ground_themes = next_row(reader)[1:]
+                game.agent_themes = next_row(reader)[1:]
+                game.monster_names['ground'] = next_row(reader)[1:]
+                game.monster_names['flying'] = next_row(reader)[1:]
+                game.monster_names['walking'] = next_row(reader)[1:]
+
+            elif row[0] == 'eat_coin':
+                # update coins eaten in this game session so far
+                assert len(row) == 3   # should only have 'eat_coin' then x and y
+                coins_eaten.append((int(row[1]), int(row[2])))
     
     # save json for leftover frames
-    if len(game.frames) > 0:
-        game_json = os.path.join(output_folder, "level_{:04d}.json".format(game_id))
-        game.save_json(game_json)
+    if len(frame_rows) > 0:
+        submit_game(pool, pending, num_workers, game, frame_rows, coins_eaten, json_format)
         game_id += 1
+
+    if pool is not None:
+        # re-raise any error from the workers
+        for result in pending:
+            result.get()
+        pool.close()
+        pool.join()
     
     return game_id, total_frames
 
@@ -442,5 +648,7 @@ def convert_csv_to_json(input_file, output_folder):
 if __name__ == "__main__":
     args = parse_args()
 
-    game_id, total_frames = convert_csv_to_json(args.input, args.output_folder)
+    game_id, total_frames = convert_csv_to_json(
+        args.input, args.output_folder, num_workers=args.num_workers, compress=args.compress
+    )
     print(f"Converted {total_frames} frames in {game_id} levels")
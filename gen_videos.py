@@ -1,14 +1,17 @@
 # Copyright (c) Meta Platforms, Inc. All Right reserved.
 
+import collections
 import glob
+import multiprocessing
 import os
 import numpy as np
 import wave
-import imageio
 import random
 from convert_csv_to_json import Game
 import argparse
 import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from construct_data_from_json import (
     define_semantic_color_map, generate_asset_paths, load_assets, load_bg_asset, draw_game_frame
 )
@@ -20,10 +23,83 @@ def parse_args():
     parser.add_argument(
         "--input_data", type=str, required=True, help="Where can we find the video frames and audio semantic maps? Typically video_data/restore_id"
     )
+    parser.add_argument(
+        "--num_workers", type=int, default=1, help="Number of processes generating videos of different levels in parallel"
+    )
     args = parser.parse_args()
 
     return args
 
+
+# level number in audio map headers and json file names, e.g. level_0042
+LEVEL_NUM_PATTERN = re.compile(r"(?<=level_)[0-9]{4}")
+
+# values per frame in audio semantic maps, same as AUDIO_MAP_SIZE in coinrun/coinrun.cpp
+AUDIO_MAP_SIZE = 9
+
+
+def load_audio_map(audio_map_dir):
+    """
+    Load the audio semantic maps saved by coinrun/collect_data.py as {level_num: uint8 array [frames, audio_map_size]}.
+    Reads the binary audio_map.bin + audio_map_index.txt, or the older audio_map.txt text format.
+    """
+    index_path = os.path.join(audio_map_dir, "audio_map_index.txt")
+    if not os.path.exists(index_path):
+        return load_audio_map_txt(os.path.join(audio_map_dir, "audio_map.txt"))
+
+    with open(index_path, 'r') as f:
+        lines = f.read().splitlines()
+    audio_map_size = int(lines[0].split(',')[1])
+    level_starts = [(int(LEVEL_NUM_PATTERN.search(l).group(0)), int(l.split(',')[1])) for l in lines[1:]]
+
+    rows = np.fromfile(os.path.join(audio_map_dir, "audio_map.bin"), dtype=np.uint8).reshape(-1, audio_map_size)
+    level_ends = [start for _, start in level_starts[1:]] + [len(rows)]
+
+    return {level_num: rows[start:end] for (level_num, start), end in zip(level_starts, level_ends)}
+
+
+def load_audio_map_txt(audio_map_path):
+    with open(audio_map_path, 'r') as f:
+        lines = f.readlines()
+
+    audio_map_data = {}
+    curr_level = 0
+    for l in lines:
+        level_num = LEVEL_NUM_PATTERN.search(l)
+        if level_num is not None:
+            curr_level = int(level_num.group(0))
+            audio_map_data[curr_level] = []
+        else:
+            audio_map_data[curr_level].append(l[:-1].split(','))
+
+    # a level without any rows still gets a [0, AUDIO_MAP_SIZE] array
+    return {
+        level_num: np.array(maps, dtype=np.uint8).reshape(len(maps), -1) if maps else np.zeros((0, AUDIO_MAP_SIZE), dtype=np.uint8)
+        for level_num, maps in audio_map_data.items()
+    }
+
+
+# signed little endian pcm samples of the given width, from rows of sample bytes to [..., channels] int32 and back
+def decode_pcm_samples(sample_bytes, sampwidth):
+    padded = np.zeros(sample_bytes.shape[:-1] + (sample_bytes.shape[-1] // sampwidth, 4), dtype=np.uint8)
+    padded[..., 4 - sampwidth:] = sample_bytes.reshape(padded.shape[:-1] + (sampwidth,))
+    return padded.view('<i4')[..., 0] >> (8 * (4 - sampwidth))
+
+
+def encode_pcm_samples(samples, sampwidth):
+    padded = (samples.astype('<i4') << (8 * (4 - sampwidth)))[..., None].view(np.uint8)
+    return padded[..., 4 - sampwidth:].reshape(samples.shape[:-1] + (samples.shape[-1] * sampwidth,))
+
+
+# windowed sinc low-pass to apply before keeping every factor-th sample, it cuts off a bit below the
+# nyquist frequency after decimation so the dropped samples don't alias
+def get_decimation_filter(factor, num_taps=97):
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    cutoff = 0.45 / factor  # in cycles per input sample
+    taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.blackman(num_taps)
+    return taps / taps.sum()
+
+
 class VideoGenerator:
 	def __init__(
 		self, 
@@ -31,6 +107,8 @@ class VideoGenerator:
 		video_fps=30, 
 		frames_per_video=96, 
 		video_sample_rate=96,
+		render_threads=4,
+		clip_threads=2,
 		
 		input_json_directory="json_metadata",
 		input_audio_map_directory="audio_semantic_map",
@@ -42,18 +120,31 @@ class VideoGenerator:
 		self.video_duration = frames_per_video / video_fps
 		self.video_sample_rate = video_sample_rate
 		self.frames_per_video = frames_per_video
+		self.render_threads = render_threads
+		self.clip_threads = clip_threads
 
 		self.audio_sample_rate = 48000
 		self.audio_samples_per_frame = self.audio_sample_rate // video_fps
 		self.audio_map = ["ladder.wav", "jump.wav", "walk.wav", "bump_head.wav", "killed.wav", "collect_coin_notification_2.wav", "monster_killed.wav", "power_up.wav"]
 		self.sound_effect_priority = [4, 7, 5, 6, 1, 3, 0, 2]
+		# position of each sound effect in sound_effect_priority, lower is more important
+		self.sound_effect_rank = [0] * len(self.audio_map)
+		for rank, sound_effect_idx in enumerate(self.sound_effect_priority):
+			self.sound_effect_rank[sound_effect_idx] = rank
+		# highest priority sound effect for each set of triggered sound effects (bit i set for sound effect i), -1 for none
+		self.sound_effect_lut = np.full(1 << len(self.audio_map), -1, dtype=np.int8)
+		for triggered_mask in range(1, len(self.sound_effect_lut)):
+			self.sound_effect_lut[triggered_mask] = next(i for i in self.sound_effect_priority if triggered_mask >> i & 1)
 		self.min_sound_effect_durations = [0, 0, 0, 0, 10, 4, 2, 8]
 		self.silence_audio = "silence.wav"
 		self.background_music = [os.path.join("coinrun/assets/sound_effects", filename) for filename in ["bg_japan.wav", "bg_technicolor.wav"]]
 		self.power_up_multiplier = 3
+		self.power_up_filter = get_decimation_filter(self.power_up_multiplier)
 
 		self.game = Game()  # for save/load metadata accompanying the video
 
+		self.input_data = input_data
+
 		self.input_json_directory = os.path.join(input_data, input_json_directory)
 		self.input_audio_map_directory = os.path.join(input_data, input_audio_map_directory)
 		self.output_json_directory = os.path.join(input_data, output_json_directory)
@@ -68,11 +159,20 @@ class VideoGenerator:
 
 
 		self.load_sound_effects()
+		self.load_background_music()
 
 		self.preprocess_audio_map_files()
 
-		self.json_level_files = sorted([path for path in glob.glob(self.input_json_directory + "/*.json")])
+		# a level can be saved both plain and compressed (e.g. converted again with --compress),
+		# then the plain json is used, the same preference as construct_data_from_json.py
+		plain_json_files = set(glob.glob(self.input_json_directory + "/*.json"))
+		self.json_level_files = sorted(plain_json_files | {
+			path for path in glob.glob(self.input_json_directory + "/*.json.gz") if path[:-len(".gz")] not in plain_json_files
+		})
+		# the first level stays loaded for generate_videos_for_level, so it isn't parsed twice
 		self.game.load_json(self.json_level_files[0])
+		self.loaded_level_json = self.json_level_files[0]
+		level_world_theme_n = self.game.world_theme_n
 
 		# load assets according to game world grid size
 		# NOTE: game engine now hard-code both kx and ky with 64 for maze_size
@@ -90,30 +190,43 @@ class VideoGenerator:
 
 			# background asset is loaded separately due to not following the grid
 			self.asset_map[world_theme_n]['background'] = load_bg_asset(asset_files, semantic_color_map, zx, zy)
+		self.game.world_theme_n = level_world_theme_n
 
 
 	def load_sound_effects(self):
-		self.audio_file_readers = []
+		# decode every sound effect (and the silence last) once, as arrays of [sample, sample bytes]
+		self.sound_effects = []
 		self.audio_params = []
 		for wav_path in self.audio_map + [self.silence_audio]:
-		    wav_in = wave.open(os.path.join("coinrun/assets/sound_effects", wav_path), 'rb')
-		    self.audio_file_readers.append(wav_in)
-		    self.audio_params.append(wav_in.getparams())
+		    with wave.open(os.path.join("coinrun/assets/sound_effects", wav_path), 'rb') as wav_in:
+		        params = wav_in.getparams()
+		        frames = wav_in.readframes(params.nframes)
+		    self.sound_effects.append(np.frombuffer(frames, dtype=np.uint8).reshape(-1, params.nchannels * params.sampwidth))
+		    self.audio_params.append(params)
+
 
+	# background music is decoded once as well, every clip plays a part of it. with forked
+	# video workers the decoded tracks are shared like the rest of the generator
+	def load_background_music(self):
+		self.background_music_tracks = []
+		self.background_music_params = []
+		for wav_path in self.background_music:
+		    with wave.open(wav_path, 'rb') as wav_in:
+		        params = wav_in.getparams()
+		        frames = wav_in.readframes(params.nframes)
+		    self.background_music_tracks.append(np.frombuffer(frames, dtype=np.uint8).reshape(-1, params.nchannels * params.sampwidth))
+		    self.background_music_params.append(params)
 
-	def find_sound_triggered(self, audio_map):
-		for sound_effect_idx in self.sound_effect_priority:
-			if (audio_map[sound_effect_idx]) == '1':
-				return sound_effect_idx
-			
-		return None
+
+	# highest priority sound effect triggered in each frame of [frames, audio_map_size] audio maps, -1 for none
+	def find_sounds_triggered(self, audio_maps):
+		triggered = np.asarray(audio_maps)[:, :len(self.audio_map)] == 1
+		# bit i of each row's mask is set when sound effect i is triggered (packbits bitorder needs numpy 1.17)
+		return self.sound_effect_lut[triggered.astype(np.uint16) @ (1 << np.arange(len(self.audio_map), dtype=np.uint16))]
 
 
 	def get_silence_pad(self, num_samples_silence):
-		self.audio_file_readers[-1].rewind()
-		silence_pad = self.audio_file_readers[-1].readframes(num_samples_silence)
-		
-		return silence_pad
+		return self.sound_effects[-1][:num_samples_silence]
 
 
 	def find_sound_duration(self, start_frame_num, sounds_triggered, min_duration=0):
@@ -123,8 +236,8 @@ class VideoGenerator:
 		while idx_of_next_sound_trigger < len(sounds_triggered) and (
 			sounds_triggered[idx_of_next_sound_trigger] is None or (
 				idx_of_next_sound_trigger - start_frame_num < min_duration and 
-				self.sound_effect_priority.index(sounds_triggered[idx_of_next_sound_trigger]) >= 
-				self.sound_effect_priority.index(sounds_triggered[start_frame_num]))):
+				self.sound_effect_rank[sounds_triggered[idx_of_next_sound_trigger]] >= 
+				self.sound_effect_rank[sounds_triggered[start_frame_num]])):
 			if sounds_triggered[idx_of_next_sound_trigger] is not None:
 				num_sounds_to_skip += 1
 			idx_of_next_sound_trigger += 1
@@ -133,19 +246,20 @@ class VideoGenerator:
 		return num_samples_for_sound, num_sounds_to_skip
 
 
-	def write_sound_effects_file(self, video_fn, audio_maps):
+	# sounds_triggered holds the sound effect chosen for each frame of the clip (see find_sounds_triggered)
+	def write_sound_effects_file(self, video_fn, sounds_triggered):
 		wav_out = wave.open(os.path.join(self.output_video_directory, video_fn + '_effects.wav'), 'wb')
 		wav_out.setparams(self.audio_params[0]) # all sound effects need to have the same parameters
 
-		# preprocess audio maps to choose one sound
-		sounds_triggered = [self.find_sound_triggered(m) for m in audio_maps]
+		sounds_triggered = [None if t < 0 else t for t in sounds_triggered.tolist()]
 
 		# pad the beginning with silence until first sound effect
+		# all pieces are collected and written at once
+		chunks = []
 		num_sounds_to_skip = 0
 		if sounds_triggered[0] is None:
 			beginning_silence_pad_duration, _ = self.find_sound_duration(0, sounds_triggered)
-			silence_pad = self.get_silence_pad(beginning_silence_pad_duration)
-			wav_out.writeframes(silence_pad)
+			chunks.append(self.get_silence_pad(beginning_silence_pad_duration))
 		for frame_num, sound_triggered in enumerate(sounds_triggered):
 			if sound_triggered is not None:
 				if num_sounds_to_skip > 0:
@@ -153,145 +267,248 @@ class VideoGenerator:
 					continue
 				num_samples_for_sound, num_sounds_to_skip = self.find_sound_duration(frame_num, sounds_triggered, self.min_sound_effect_durations[sound_triggered])
 				
-				self.audio_file_readers[sound_triggered].rewind() # make sure we read from the beginning of the sound
-				sound_effect_truncated = self.audio_file_readers[sound_triggered].readframes(num_samples_for_sound)
-				wav_out.writeframes(sound_effect_truncated)
+				sound_effect = self.sound_effects[sound_triggered]
+				chunks.append(sound_effect[:num_samples_for_sound])
 
-				if self.audio_params[sound_triggered][3] < num_samples_for_sound:
+				if len(sound_effect) < num_samples_for_sound:
 					# need to pad with silence
-					silence_pad = self.get_silence_pad(num_samples_for_sound - self.audio_params[sound_triggered][3])
-					wav_out.writeframes(silence_pad)
+					chunks.append(self.get_silence_pad(num_samples_for_sound - len(sound_effect)))
 
+		if chunks:
+			wav_out.writeframes(np.concatenate(chunks).tobytes())
 		wav_out.close()
 
 
-	def write_background_track_and_mix(self, audio_maps, video_fn, video_index):
-		background_music_wav = wave.open(self.background_music[self.game.world_theme_n], 'rb')
-		background_music_duration = background_music_wav.getnframes() // background_music_wav.getframerate()
+	def write_background_track(self, audio_maps, video_fn, video_index):
+		background_music = self.background_music_tracks[self.game.world_theme_n]
+		background_music_params = self.background_music_params[self.game.world_theme_n]
+		background_music_duration = background_music_params.nframes // background_music_params.framerate
 		background_music_start = (video_index * self.video_duration) % (background_music_duration - self.video_duration * self.power_up_multiplier)
-		background_music_wav.readframes(int(self.audio_sample_rate*background_music_start))
-
-		power_up_mode_wav_out = wave.open(os.path.join(self.output_video_directory, video_fn + '_pm_bg.wav'), 'wb')
-		power_up_mode_wav_out.setparams(background_music_wav.getparams())
-		power_up_mode_wav_out.setframerate(self.audio_sample_rate * self.power_up_multiplier)
-
-		normal_mode_wav_out = wave.open(os.path.join(self.output_video_directory, video_fn + '_nm_bg.wav'), 'wb')
-		normal_mode_wav_out.setparams(background_music_wav.getparams())
-		normal_mode_wav_out.setframerate(self.audio_sample_rate)
-
-		for frame_num, audio_map in enumerate(audio_maps):
-			power_up_mode = audio_map[-1] == '1'
-			if power_up_mode:
-				power_up_mode_wav_out.writeframes(background_music_wav.readframes(self.audio_samples_per_frame * self.power_up_multiplier))
-				normal_mode_wav_out.writeframes(self.get_silence_pad(self.audio_samples_per_frame))
-			else:
-				normal_mode_wav_out.writeframes(background_music_wav.readframes(self.audio_samples_per_frame))
-				power_up_mode_wav_out.writeframes(self.get_silence_pad(self.audio_samples_per_frame * self.power_up_multiplier))
-			
-		power_up_mode_wav_out.close()
-		normal_mode_wav_out.close()
-
-		os.system("ffmpeg -y -i {} -i {} -filter_complex amix=inputs=2:duration=longest {}".format(
-			os.path.join(self.output_video_directory, video_fn + '_pm_bg.wav'),
-			os.path.join(self.output_video_directory, video_fn + '_nm_bg.wav'),
-			os.path.join(self.output_video_directory, video_fn + '_bg_mix.wav')))
-		os.system("ffmpeg -y -i {} -i {} -filter_complex amix=inputs=2:duration=longest {}".format(
-			os.path.join(self.output_video_directory, video_fn + '_bg_mix.wav'),
-			os.path.join(self.output_video_directory, video_fn + '_effects.wav'),
-			os.path.join(self.output_video_directory, video_fn + '_final_mix.wav')))
-		os.system("ffmpeg -y -i {} -i {} {}".format(
-			os.path.join(self.output_video_directory, video_fn + '_final_mix.wav'),
-			os.path.join(self.output_video_directory, video_fn + '_tmp.mp4'),
-			os.path.join(self.output_video_directory, video_fn + '.mp4')))
-
-		os.remove(os.path.join(self.output_video_directory, video_fn + '_pm_bg.wav'))
-		os.remove(os.path.join(self.output_video_directory, video_fn + '_nm_bg.wav'))
-		os.remove(os.path.join(self.output_video_directory, video_fn + '_bg_mix.wav'))
-		os.remove(os.path.join(self.output_video_directory, video_fn + '_effects.wav'))
-		os.remove(os.path.join(self.output_video_directory, video_fn + '_final_mix.wav'))
-		os.remove(os.path.join(self.output_video_directory, video_fn + '_tmp.mp4'))
-
-
-	def is_interesting_level(self, level_num):
+		background_music_offset = int(self.audio_sample_rate*background_music_start)
+
+		background_wav_out = wave.open(os.path.join(self.output_video_directory, video_fn + '_bg.wav'), 'wb')
+		background_wav_out.setparams(background_music_params)
+		background_wav_out.setframerate(self.audio_sample_rate)
+
+		# each frame takes the next chunk of background music, 3x longer in power up mode (played back 3x faster).
+		# power up chunks are low-pass filtered and decimated to the frame length here, so the whole track is at
+		# the output rate and ffmpeg doesn't have to resample anything.
+		# take all the music of the clip at once and build the track with numpy, as an array of [frame, sample, sample bytes]
+		samples_pm = self.audio_samples_per_frame * self.power_up_multiplier
+		samples_nm = self.audio_samples_per_frame
+		power_up_mode = np.asarray(audio_maps)[:, -1] == 1
+		samples_per_frame = np.where(power_up_mode, samples_pm, samples_nm)
+		music_offsets = np.cumsum(samples_per_frame) - samples_per_frame
+
+		bytes_per_sample = background_music.shape[1]
+		music = background_music[background_music_offset:background_music_offset + int(samples_per_frame.sum())]
+
+		background_track = np.empty((len(audio_maps), samples_nm, bytes_per_sample), dtype=np.uint8)
+		background_track[~power_up_mode] = music[music_offsets[~power_up_mode][:, None] + np.arange(samples_nm)]
+		if power_up_mode.any():
+			# the filter looks at the music around the clip as well, edge samples are repeated at the ends of the track
+			half_taps = len(self.power_up_filter) // 2
+			context_start = max(background_music_offset - half_taps, 0)
+			context_end = min(background_music_offset + len(music) + half_taps, len(background_music))
+			context = decode_pcm_samples(background_music[context_start:context_end], background_music_params.sampwidth)
+			context = np.pad(context, (
+				(half_taps - (background_music_offset - context_start), half_taps - (context_end - background_music_offset - len(music))),
+				(0, 0),
+			), mode='edge')
+			filtered_music = np.stack([
+				np.convolve(context[:, channel], self.power_up_filter, mode='valid') for channel in range(context.shape[1])
+			], axis=1)
+			sample_limit = 1 << (8 * background_music_params.sampwidth - 1)
+			filtered_music = np.clip(np.rint(filtered_music), -sample_limit, sample_limit - 1).astype(np.int32)
+			background_track[power_up_mode] = encode_pcm_samples(
+				filtered_music[music_offsets[power_up_mode][:, None] + np.arange(0, samples_pm, self.power_up_multiplier)],
+				background_music_params.sampwidth,
+			)
+
+		background_wav_out.writeframes(background_track.tobytes())
+		background_wav_out.close()
+
+
+	# raw rgb frames are piped to ffmpeg, which encodes them, mixes the background track with the sound effects
+	# and muxes the audio into the video in a single process. the weights and volume keep the levels of the
+	# earlier mix of separate power up and normal mode tracks (1/4 background, 1/2 effects)
+	def write_video_with_audio(self, video_fn, frames):
+		video_path_prefix = os.path.join(self.output_video_directory, video_fn)
+		video_proc = None
+		try:
+			for frame in frames:
+				if video_proc is None:
+					w, h = frame.size
+					video_proc = subprocess.Popen([
+						"ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+						"-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "{}x{}".format(w, h), "-r", str(self.video_fps), "-i", "-",
+						"-i", video_path_prefix + '_bg.wav',
+						"-i", video_path_prefix + '_effects.wav',
+						"-filter_complex", "[1:a][2:a]amix=inputs=2:duration=longest:weights=1 2,volume=0.75[a]",
+						"-map", "0:v", "-map", "[a]", "-c:v", "libx264", "-pix_fmt", "yuv420p",
+						video_path_prefix + '.mp4',
+					], stdin=subprocess.PIPE)
+				video_proc.stdin.write(frame.tobytes())
+			video_proc.stdin.close()
+			if video_proc.wait() != 0:
+				raise subprocess.CalledProcessError(video_proc.returncode, video_proc.args)
+		except BaseException:
+			# rendering or encoding failed, don't leave ffmpeg running or a partial video behind
+			if video_proc is not None:
+				try:
+					video_proc.stdin.close()
+				except OSError:
+					pass
+				video_proc.kill()
+				video_proc.wait()
+			if os.path.exists(video_path_prefix + '.mp4'):
+				os.remove(video_path_prefix + '.mp4')
+			raise
+		finally:
+			os.remove(video_path_prefix + '_bg.wav')
+			os.remove(video_path_prefix + '_effects.wav')
+
+
+	# a level is interesting when one of its frames plays the killed, coin or monster killed sound effect.
+	# this goes by the sound effect chosen for the frame, not by every triggered one (power up outranks them)
+	def is_interesting_level(self, level_sounds_triggered):
 		if len(self.game.frames) < self.frames_per_video:
 			return False
 
-		return any(self.find_sound_triggered(m) in (4, 5, 6) for m in self.audio_map_data[level_num])
+		return np.isin(level_sounds_triggered, (4, 5, 6)).any()
 
 
 	def save_videos_for_level(
 		self,
 		level_num, 
+		level_sounds_triggered,
 		):
 		n_frames_in_level = len(self.game.frames)
 		random.seed(self.game.level_seed) # want this to be reproducible
 		start_frame_idx = random.randint(0, min(self.video_sample_rate, max(n_frames_in_level - self.frames_per_video, 0))) # choose an initial frame
 		n_vids = 0
+		render_executor = ThreadPoolExecutor(max_workers=self.render_threads)
+		# a few clips are in flight at once, so the encode of one clip in ffmpeg overlaps
+		# with rendering the frames of the next. clips only read the loaded game
+		clip_executor = ThreadPoolExecutor(max_workers=self.clip_threads)
+		pending_clips = []
 		for video_index, start_frame in enumerate(range(start_frame_idx, n_frames_in_level, self.video_sample_rate)):
 			if start_frame + self.frames_per_video <= n_frames_in_level:
-				video_fn = self.filename_prefix + 'level_{:04d}_video_frames_{:04d}_to_{:04d}'.format(level_num, start_frame, start_frame + self.frames_per_video - 1)
+				pending_clips.append(clip_executor.submit(
+					self.save_video_clip, level_num, start_frame, n_vids, level_sounds_triggered, render_executor
+				))
+				n_vids += 1
 
-				writer = imageio.get_writer(os.path.join(self.output_video_directory, video_fn + '_tmp.mp4'), fps=self.video_fps)
-				for i in range(start_frame, start_frame + self.frames_per_video):
-					writer.append_data(np.array(draw_game_frame(self.game, i, self.asset_map[self.game.world_theme_n], self.kx, self.ky, gen_original=True)))
-				writer.close()
+		try:
+			for clip in pending_clips:
+				clip.result()
+		finally:
+			# after an error, clips that haven't started are dropped (shutdown(cancel_futures=True) needs python 3.9)
+			for clip in pending_clips:
+				clip.cancel()
+			clip_executor.shutdown()
+			render_executor.shutdown()
+		return n_vids
 
-				# save json within the range of frames used in the video
-				json_output_path = os.path.join(self.output_json_directory, video_fn + '.json')
-				self.game.save_json(json_output_path, f_start=start_frame, f_end=(start_frame + self.frames_per_video))
-				
-				self.write_sound_effects_file(
-					video_fn,
-					self.audio_map_data[level_num][start_frame:start_frame + self.frames_per_video],
-				)
 
-				self.write_background_track_and_mix(
-					self.audio_map_data[level_num][start_frame:start_frame + self.frames_per_video],
-					video_fn,
-					n_vids
-				)
+	def save_video_clip(self, level_num, start_frame, video_index, level_sounds_triggered, render_executor):
+		end_frame = start_frame + self.frames_per_video
+		video_fn = self.filename_prefix + 'level_{:04d}_video_frames_{:04d}_to_{:04d}'.format(level_num, start_frame, end_frame - 1)
 
-				n_vids += 1
+		# the per-level arrays are sliced as views, nothing is copied per clip
+		# audio tracks are written first, so they can be muxed while the frames are encoded
+		self.write_sound_effects_file(
+			video_fn,
+			level_sounds_triggered[start_frame:end_frame],
+		)
+
+		self.write_background_track(
+			self.audio_map_data[level_num][start_frame:end_frame],
+			video_fn,
+			video_index
+		)
+
+		self.write_video_with_audio(
+			video_fn,
+			self.render_frames(render_executor, range(start_frame, end_frame)),
+		)
+
+		# save json within the range of frames used in the video
+		json_output_path = os.path.join(self.output_json_directory, video_fn + '.json')
+		self.game.save_json(json_output_path, f_start=start_frame, f_end=end_frame)
+
+
+	# frames are rendered ahead by a few threads and yielded in order,
+	# the window bounds how many rendered frames wait in memory
+	def render_frames(self, render_executor, frame_ids):
+		pending_frames = collections.deque()
+		for i in frame_ids:
+			pending_frames.append(render_executor.submit(self.render_frame, i))
+			if len(pending_frames) > 2 * self.render_threads:
+				yield pending_frames.popleft().result()
+		while pending_frames:
+			yield pending_frames.popleft().result()
 
-		return n_vids
+
+	# the rendered rgb image is piped as is, without converting it to a numpy array first
+	def render_frame(self, frame_id):
+		return draw_game_frame(self.game, frame_id, self.asset_map[self.game.world_theme_n], self.kx, self.ky, gen_original=True)
 
 
 	def preprocess_audio_map_files(self):
-		with open(self.input_audio_map_directory + "/audio_map.txt", 'r') as f:
-			lines = f.readlines()
-
-		self.audio_map_data = {}
-		curr_level = 0
-		for l in lines:
-			level_num = re.search(r"(?<=level_)[0-9]{4}", l)
-			if level_num is not None:
-				curr_level = int(level_num.group(0))
-				self.audio_map_data[curr_level] = []
-			else:
-				decoded_audio_map = l[:-1].split(',')
-				self.audio_map_data[curr_level].append(decoded_audio_map)
-
-
-	def generate_videos(self):
-		tot_videos_generated = 0
-		for level_json in self.json_level_files:
-			level_num = int(re.search(r"(?<=level_)[0-9]{4}", level_json).group(0))
+		self.audio_map_data = load_audio_map(self.input_audio_map_directory)
+
+
+	def generate_videos_for_level(self, level_json):
+		level_num = int(LEVEL_NUM_PATTERN.search(level_json).group(0))
+		if level_json != self.loaded_level_json:
 			self.game.load_json(level_json)
+			self.loaded_level_json = level_json
+
+		# the sound effects are chosen once for the whole level, they decide if the level is used and
+		# the clips (which can overlap) take their part of them
+		level_sounds_triggered = self.find_sounds_triggered(self.audio_map_data[level_num])
+		if not self.is_interesting_level(level_sounds_triggered):
+			return 0
+
+		return self.save_videos_for_level(level_num, level_sounds_triggered)
+
+
+	def generate_videos(self, num_workers=1):
+		if num_workers <= 1:
+			return sum(self.generate_videos_for_level(level_json) for level_json in self.json_level_files)
+
+		# levels are independent, each worker process renders whole levels with its own generator.
+		# with the fork start method workers inherit this generator, so the loaded assets are shared
+		# copy-on-write instead of being pickled or loaded again in every worker
+		global video_worker_generator
+		video_worker_generator = self
+		try:
+			with multiprocessing.Pool(num_workers, initializer=init_video_worker, initargs=(self.input_data,)) as pool:
+				return sum(pool.imap_unordered(generate_videos_in_worker, self.json_level_files))
+		finally:
+			video_worker_generator = None
+
+
+video_worker_generator = None
+
 
-			if not self.is_interesting_level(level_num):
-				continue
+def init_video_worker(input_data):
+	global video_worker_generator
+	# only load everything again when nothing was inherited from the parent (spawn start method)
+	if video_worker_generator is None:
+		video_worker_generator = VideoGenerator(input_data=input_data)
 
-			tot_videos_generated += self.save_videos_for_level(level_num)
-	
 
-		return tot_videos_generated
+def generate_videos_in_worker(level_json):
+	return video_worker_generator.generate_videos_for_level(level_json)
 
 
 if __name__ == "__main__":
     args = parse_args()
 
     video_generator = VideoGenerator(input_data=args.input_data)
-    tot_videos_generated = video_generator.generate_videos()
+    tot_videos_generated = video_generator.generate_videos(num_workers=args.num_workers)
 
     print(f"Generated {tot_videos_generated} videos")
 
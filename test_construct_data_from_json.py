@@ -0,0 +1,81 @@
+import math
+
+import numpy as np
+from PIL import Image
+
+from construct_data_from_json import LAVA_MIDDLE, LAVA_SURFACE, Asset, paint_lava
+
+
+def intersect_rects(rect1, rect2):
+    x0, y0 = max(rect1[0], rect2[0]), max(rect1[1], rect2[1])
+    x1, y1 = min(rect1[0] + rect1[2], rect2[0] + rect2[2]), min(rect1[1] + rect1[3], rect2[1] + rect2[3])
+    if x1 > x0 and y1 > y0:
+        return [x0, y0, x1 - x0, y1 - y0]
+    return None
+
+
+def integer_rect(rect):
+    return [math.floor(rect[0]), math.floor(rect[1]), math.ceil(rect[2]), math.ceil(rect[3])]
+
+
+# semantic assets were originally loaded with every alpha > 0 set to 255
+def binarize_alpha_channel(img):
+    alpha = np.asarray(img)[:, :, 3]
+    img = img.copy()
+    img.putalpha(Image.fromarray(np.where(alpha > 0, 255, 0).astype(np.uint8)))
+    return img
+
+
+# lava in semantic maps as originally drawn: both halves of the binarized asset pasted into a PIL image
+def paint_baseline_lava(img, tile_rect, asset, state_time):
+    src_asset = binarize_alpha_channel(asset.asset)
+    d1 = tile_rect[:]
+    d2 = tile_rect[:]
+    sr = [0, 0, asset.size[0], asset.size[1]]
+    sr1 = sr[:]
+    sr2 = sr[:]
+    tr = state_time * 0.1
+    tr -= int(tr)
+    tr *= -1
+    d1[0] += tr * tile_rect[2]
+    d2[0] += tile_rect[2] + tr * tile_rect[2]
+    sr1[0] += -tr * asset.size[0]
+    sr2[0] += -asset.size[0] - tr * asset.size[0]
+    d1 = intersect_rects(d1, tile_rect)
+    d2 = intersect_rects(d2, tile_rect)
+    if d1 is not None:
+        d1[2] += 0.5
+    if d2 is not None:
+        d2[0] -= 0.5
+        d2[2] += 0.5
+    sr1 = intersect_rects(sr1, sr)
+    sr2 = intersect_rects(sr2, sr)
+    for src, dst in ((sr1, d1), (sr2, d2)):
+        if src is None or dst is None:
+            continue
+        crop = src_asset.crop(integer_rect([src[0], src[1], src[0] + src[2], src[1] + src[3]]))
+        dst = integer_rect(dst)
+        crop = crop.resize((dst[2], dst[3]), resample=Image.NEAREST)
+        img.paste(asset.label, [dst[0], dst[1], dst[0] + dst[2], dst[1] + dst[3]], crop)
+
+
+def test_semantic_lava_matches_baseline():
+    kx = ky = 256 / 13
+    for name, file, label in [(LAVA_MIDDLE, 'kenney/Tiles/lava.png', 10), (LAVA_SURFACE, 'kenney/Tiles/lavaTop_low.png', 20)]:
+        asset = Asset(name, file, kx=kx, ky=ky, semantic_color=label)
+        for state_time in range(12):
+            phase = state_time * 0.1
+            phase -= int(phase)
+            expected = Image.new('L', (256, 256))
+            img = np.zeros((256, 256), dtype=np.uint8)
+            # tile rects as in draw_game_frame, with fractional offsets and tiles crossing the image border
+            for i in range(-1, 14):
+                tile_rect = [kx * i + 3.7 - 0.1, ky * (i % 5) + 1.3 - 0.1, kx + .5 + 0.2, ky + .5 + 0.2]
+                paint_baseline_lava(expected, tile_rect, asset, state_time)
+                paint_lava(img, tile_rect, asset, phase)
+            assert np.count_nonzero(img)
+            np.testing.assert_array_equal(img, np.asarray(expected))
+
+
+if __name__ == '__main__':
+    test_semantic_lava_matches_baseline()
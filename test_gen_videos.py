@@ -0,0 +1,30 @@
+import os
+import tempfile
+
+import numpy as np
+
+from gen_videos import AUDIO_MAP_SIZE, load_audio_map
+
+
+def test_load_audio_map_txt_empty_level():
+    with tempfile.TemporaryDirectory() as audio_map_dir:
+        with open(os.path.join(audio_map_dir, "audio_map.txt"), "w") as f:
+            f.write(
+                "level_0000\n"
+                "1,0,0,0,0,0,0,0,0\n"
+                "0,0,0,0,0,1,0,0,1\n"
+                "level_0001\n"
+                "level_0002\n"
+                "0,0,1,0,0,0,0,0,0\n"
+            )
+        audio_map_data = load_audio_map(audio_map_dir)
+
+    assert sorted(audio_map_data) == [0, 1, 2]
+    for level_num, n_frames in [(0, 2), (1, 0), (2, 1)]:
+        assert audio_map_data[level_num].shape == (n_frames, AUDIO_MAP_SIZE)
+        assert audio_map_data[level_num].dtype == np.uint8
+    assert audio_map_data[0][1].tolist() == [0, 0, 0, 0, 0, 1, 0, 0, 1]
+
+
+if __name__ == '__main__':
+    test_load_audio_map_txt_empty_level()